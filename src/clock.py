@@ -1,51 +1,68 @@
 
 import sys
 import asyncio
+from micropython import const
 
 from display import write_text
+from display import CALLEN_MODE
+from display import CELESTE_MODE
 
 from lib.mytime import lcl_timetuple
 
-# draw the clock into the framebuf as a mask
-async def clock_coro(frmmsk):
-    global is_nighttime
+_TICK_MARGIN_MS = const(5) # wake just after the boundary, not just before
+
+# ms from now (sec, msec) to the next second, or minute, boundary
+def ms_to_next_tick(sec, msec, per_second=True):
+    if per_second:
+        return 1000 - msec + _TICK_MARGIN_MS
+    return (60 - sec)*1000 - msec + _TICK_MARGIN_MS
+
+# draw the clock into the frame as a mask
+# wakes on second boundaries, or minute boundaries if nothing changes with
+# the second (the colon doesn't blink and the mode's colour isn't timed,
+# CALLEN_MODE's hue moves every second), and publishes the time to the frame
+# for display_coro.  Night mode changes on the hour, a minute boundary.
+async def clock_coro(frame, mode, blink=True):
     try:
         while True:
             try:
-                await asyncio.sleep_ms(250)
                 yr, mth, day, hr, min, sec, msec, = lcl_timetuple()
-                is_nighttime = hr <= 8 or hr >= 19
+                frame.set_night(hr <= 8 or hr >= 19)
                 if yr < 2026:
                     if sec%2==0:
-                        write_text(frmmsk = frmmsk,
-                                   text = b'hello')
+                        write_text(frame = frame,
+                                   text  = b'hello')
                     else:
-                        if CLOCK_MODE == CALLEN_MODE:
-                            write_text(frmmsk  = frmmsk,
-                                    text = b'Calln')
-                        elif CLOCK_MODE == CELESTE_MODE:
-                            write_text(frmmsk  = frmmsk,
-                                    text = b'Celst')
-                    await asyncio.sleep_ms(1000)
-                    continue
-
-                await time_24hour(frmmsk = frmmsk)
+                        if mode == CALLEN_MODE:
+                            write_text(frame = frame,
+                                       text  = b'Calln')
+                        elif mode == CELESTE_MODE:
+                            write_text(frame = frame,
+                                       text  = b'Celst')
+                    per_second = True
+                else:
+                    time_24hour(frame = frame,
+                                hr    = hr,
+                                min   = min,
+                                sec   = sec,
+                                blink = blink)
+                    per_second = blink or mode == CALLEN_MODE
+                frame.set_time(hr, min, sec)
+                await asyncio.sleep_ms(ms_to_next_tick(sec, msec, per_second))
 
             except asyncio.CancelledError:
                 raise
             except Exception as err:
                 sys.print_exception(err)
+                await asyncio.sleep_ms(1000)
     except asyncio.CancelledError:
         raise
     except Exception as err:
         sys.print_exception(err)
 
-async def time_24hour(frmmsk):
-    yr, mth, day, hr, min, sec, msec, = lcl_timetuple()
-    sep = ':' if sec%2==0 else ' '
+def time_24hour(frame, hr, min, sec, blink=True):
+    sep = ':' if sec%2==0 or not blink else ' '
     time = '{:02}{}{:02}'.format(hr,sep,min)
-    hue = (min*60+sec)*360//(60*60)
-    val = 1 if (hr < 8 or hr > 19) else 5
-    write_text(frmmsk  = frmmsk,
-               text    = time.encode(),
+    write_text(frame = frame,
+               text  = time.encode(),
                )
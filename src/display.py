@@ -1,12 +1,21 @@
 
 import sys
+import time
 import asyncio
 import micropython
+from asyncio import Event
 from font import char_to_pixels
 
 NEOPIXELS_LEN = const(320)
 NEOPIXELS_ROW = const(40)
+NEOPIXELS_COL = const(8)
 _NEOPIXELS_MAX_CHARS = const(5)
+_TEXT_CACHE_BUDGET = const(640) # bytes of rasterised text kept by text_cache
+_DISPLAY_STATS_MS = const(10000)
+
+# clock modes
+CALLEN_MODE  = const(0)
+CELESTE_MODE = const(1)
 
 
 # hue
@@ -30,21 +39,95 @@ def xy_to_i(x:int, y:int) -> int:
 def i_to_xy(i:int):
     return (i % NEOPIXELS_ROW, i // NEOPIXELS_ROW)
 
-def write_text(frmmsk, text:bytes, jright=True, hue=LED_HUE_LIGHTBLUE, val=5):
+# The frame shared between the producers (clock_coro, night mode, hue) and
+# display_coro.  Anything that changes what is on screen bumps gen,
+# display_coro only renders and writes the neopixels when gen has moved.
+# mask is a 1bpp NEOPIXELS_ROWxNEOPIXELS_COL bitmap, one byte per column with
+# bit y for row y.  That is framebuf.MONO_VLSB and the layout of the font.
+class Frame:
+    def __init__(self):
+        self.mask  = bytearray(NEOPIXELS_ROW)
+        self.text  = None  # text currently in mask
+        self.night = False
+        self.gen   = 0
+
+        # time of the last clock tick
+        self.hr  = 0
+        self.min = 0
+        self.sec = 0
+
+        # set on every bump or clock tick, wakes display_coro
+        self.changed = Event()
+
+        #stats
+        self.rendered = 0
+        self.skipped  = 0
+
+    def bump(self):
+        self.gen += 1
+        self.changed.set()
+
+    # publish the time, time driven colours are recomputed on the wake up
+    def set_time(self, hr, min, sec):
+        self.hr  = hr
+        self.min = min
+        self.sec = sec
+        self.changed.set()
+
+    def set_night(self, night):
+        if night != self.night:
+            self.night = night
+            self.bump()
+
+# LRU cache of rasterised strings.  Each entry is the full packed mask for a
+# padded string (eg b'12:34', b'12 34'), so a hit is a single buffer copy.
+# The number of entries is bounded by budget bytes of raster.
+class TextCache:
+    def __init__(self, budget=_TEXT_CACHE_BUDGET):
+        self.size  = max(budget//NEOPIXELS_ROW, 1)
+        self.cache = {} # text -> [last used tick, raster]
+        self.tick  = 0
+
+        #stats
+        self.hits   = 0
+        self.misses = 0
+
+    def get(self, text):
+        self.tick += 1
+        e = self.cache.get(text)
+        if e:
+            self.hits += 1
+            e[0] = self.tick
+            return e[1]
+        self.misses += 1
+        cache = self.cache
+        if len(cache) >= self.size:
+            # evict least recently used, reuse its raster
+            e = cache.pop(min(cache, key=lambda k: cache[k][0]))
+            e[0] = self.tick
+        else:
+            e = [self.tick, bytearray(NEOPIXELS_ROW)]
+        raster = e[1]
+        for i,c in enumerate(text):
+            raster[i*8:(i+1)*8] = char_to_pixels(c) # glyph columns
+        cache[text] = e
+        return raster
+
+text_cache = TextCache()
+
+def write_text(frame, text:bytes, jright=True, hue=LED_HUE_LIGHTBLUE, val=5):
     j = max(_NEOPIXELS_MAX_CHARS-len(text),0)
     if jright:
         text = b' '*j+text
     else:
         text = text + b' '*j
-    for i in range(NEOPIXELS_LEN):
-        frmmsk[i] = 0
-    for i,c in enumerate(text[:_NEOPIXELS_MAX_CHARS]):
-        ps = char_to_pixels(c) # get character
-        for x,p in enumerate(ps): # for each column
-            for y in range(8): # for each row
-                v = val if p&(0x01<<y) else 0
-                # neo[xy_to_i(i*8+x, y)] = hsv_to_rgb(hue, 255, v)
-                frmmsk[xy_to_i(i*8+x, y)] = 1 if p&(0x01<<y) else 0
+    text = text[:_NEOPIXELS_MAX_CHARS]
+    if text == frame.text:
+        return # already drawn, don't bump the frame
+    # text is padded to fill the display, the raster covers every column
+    frame.mask[:] = text_cache.get(text)
+    frame.text = text
+    frame.bump()
 
 @micropython.viper
 def hsv_to_rgb(h:int, s:int, v:int):
@@ -70,3 +153,135 @@ def hsv_to_rgb(h:int, s:int, v:int):
     if reg == 5:
         return (v, p, q)
 
+
+
+_RGB_OFF = (0, 0, 0)
+
+# Colour palette for the render path.  Rather than hsv_to_rgb per pixel per
+# frame, keep a GRB ordered table of every hue at the current val, and the
+# GRB colour of each column derived from it.  Both are only rebuilt when their
+# inputs change, colouring a frame is then a copy from cols into neo.buf.
+class Palette:
+    def __init__(self):
+        self.hues   = bytearray(256*3)           # GRB of each hue at self.val
+        self.cols   = bytearray(NEOPIXELS_ROW*3) # GRB of each column
+        self.rgb    = _RGB_OFF                   # colour when spread=0
+        self.val    = -1
+        self.hue    = -1
+        self.xoff   = 0
+        self.spread = 0
+
+    # rebuild the hue table, only needed when the brightness changes
+    def set_val(self, val):
+        if val == self.val:
+            return False
+        hues = self.hues
+        for h in range(256):
+            r,g,b = hsv_to_rgb(h, 255, val)
+            hues[h*3]   = g
+            hues[h*3+1] = r
+            hues[h*3+2] = b
+        self.val = val
+        self.hue = -1 # column colours are stale
+        return True
+
+    # column x is coloured hue + ((x+xoff)*spread)//NEOPIXELS_ROW
+    #   spread=0   -> solid colour
+    #   spread=256 -> full rainbow across the display, xoff scrolls it
+    def set_hue(self, hue, xoff=0, spread=0):
+        if hue == self.hue and xoff == self.xoff and spread == self.spread:
+            return False
+        hues = self.hues
+        cols = self.cols
+        for x in range(NEOPIXELS_ROW):
+            h = ((hue + ((x+xoff)*spread)//NEOPIXELS_ROW) & 0xff)*3
+            cols[x*3]   = hues[h]
+            cols[x*3+1] = hues[h+1]
+            cols[x*3+2] = hues[h+2]
+        if spread == 0:
+            self.rgb = hsv_to_rgb(hue, 255, self.val)
+        self.hue    = hue
+        self.xoff   = xoff
+        self.spread = spread
+        return True
+
+    # colour the frame mask (1bpp, MONO_VLSB) into the neopixel buffer
+    def render(self, frmmsk, neo):
+        if self.spread == 0:
+            neo.blit_mask(frmmsk, self.rgb, _RGB_OFF, NEOPIXELS_ROW)
+        else:
+            _render_cols(neo.buf, frmmsk, self.cols)
+
+@micropython.viper
+def _render_cols(buf:ptr8, frmmsk:ptr8, cols:ptr8):
+    o:int = 0 # buf offset
+    c:int = 0 # cols offset
+    x:int = 0
+    y:int = 0
+    while y < NEOPIXELS_COL:
+        x = 0
+        c = 0
+        while x < NEOPIXELS_ROW:
+            if (frmmsk[x] >> y) & 1:
+                buf[o]   = cols[c]
+                buf[o+1] = cols[c+1]
+                buf[o+2] = cols[c+2]
+            else:
+                buf[o]   = 0
+                buf[o+1] = 0
+                buf[o+2] = 0
+            o += 3
+            c += 3
+            x += 1
+        y += 1
+
+# colorize and write to neopixel, only when the frame changed
+# sleeps on frame.changed unless the colours are animating
+async def display_coro(frame, neo, mode):
+    shift = 0
+    speed = 1
+    gen = -1 # frame generation last written
+    palette = Palette()
+    ticks_stats = time.ticks_ms()
+    try:
+        while True:
+            try:
+                if mode == CELESTE_MODE and not frame.night:
+                    await asyncio.sleep_ms(3)
+                else:
+                    await frame.changed.wait()
+                frame.changed.clear()
+                shift += speed
+                if frame.night:
+                    palette.set_val(1)
+                    hue_changed = palette.set_hue(LED_HUE_PUPLE)
+                elif mode == CELESTE_MODE:
+                    palette.set_val(5)
+                    hue_changed = palette.set_hue(0, xoff = -(shift//20), spread = 256)
+                elif mode == CALLEN_MODE:
+                    palette.set_val(5)
+                    hue_changed = palette.set_hue((frame.min*60+frame.sec)*360//(60*60))
+                if hue_changed:
+                    frame.bump()
+                    frame.changed.clear()
+
+                if time.ticks_diff(time.ticks_ms(), ticks_stats) >= _DISPLAY_STATS_MS:
+                    print('DISPLAY rendered', frame.rendered, 'skipped', frame.skipped,
+                          'text hits', text_cache.hits, 'misses', text_cache.misses)
+                    ticks_stats = time.ticks_ms()
+
+                if frame.gen == gen:
+                    frame.skipped += 1
+                    continue
+                gen = frame.gen
+                palette.render(frame.mask, neo)
+                neo.write()
+                frame.rendered += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                sys.print_exception(err)
+    except asyncio.CancelledError:
+        raise
+    except Exception as err:
+        sys.print_exception(err)
@@ -4,8 +4,6 @@ import sys
 import gc
 from micropython import const
 import esp32
-import io
-import deflate
 
 from asyncio import Event
 from primitives.events import WaitAny
@@ -21,6 +19,8 @@ from wifi.wifi import Wifi
 from wifi.wifi import WifiSocket
 
 from mqtt.core import MQTTCore
+from mqtt.defs import PROTOCOL_LEVEL_5
+from mqtt.router import MQTTRouter
 
 from lib.ntptime import settime as ntp_settime
 from lib.mytime import lcl_timetuple
@@ -28,12 +28,13 @@ from lib.mytime import lcl_timetuple
 from clock import clock_coro
 
 from display import NEOPIXELS_LEN
-from display import NEOPIXELS_ROW
-from display import i_to_xy
-from display import hsv_to_rgb
+from display import CALLEN_MODE
+from display import CELESTE_MODE
+from display import Frame
+from display import display_coro
+
+from ota import OTAWriter
 
-CALLEN_MODE = 0
-CELESTE_MODE = 1
 if board.MAC == 'dc:54:75:d8:6f:48':
     CLOCK_MODE = CELESTE_MODE
 elif board.MAC == 'dc:54:75:d8:70:38':
@@ -57,8 +58,6 @@ PIN_BUTTON_B = const(10)
 PIN_BUTTON_C = const(33)
 PIN_BUTTON_D = const(34)
 
-is_nighttime = False
-
 async def gc_coro():
     try:
         while True:
@@ -73,6 +72,11 @@ async def gc_coro():
 
 async def mqtt_coro(wifi):
     rx_task = None
+    mqtt = None
+    # made once, its OTAWriter outlives connections so a transfer resumes
+    # after a reconnect (go-back-N from the writer's next page), publish
+    # goes to the current connection
+    on_ota = ota_handler(publish = lambda **kw: mqtt.publish(**kw))
     while True:
         try:
             use_ssl = True
@@ -83,9 +87,16 @@ async def mqtt_coro(wifi):
                                   ) as wifisocket:
                 async with MQTTCore(socket    = wifisocket,
                                     client_id = wifi.client_id,
+                                    zerocopy  = True,
+                                    protocol  = PROTOCOL_LEVEL_5,
                                     ) as mqtt:
-                    await mqtt.subscribe(topics = [MQTT_ROOT+b'/#'])
-                    rx_task = asyncio.create_task(mqtt_rx_coro(rx_q = mqtt.mqtt_app_rx_q))
+                    router = MQTTRouter(topics = mqtt.topics)
+                    router.add(MQTT_ROOT+b'/ota/+', on_ota)
+                    await mqtt.subscribe(topics   = [MQTT_ROOT+b'/#'],
+                                         no_local = True)
+                    rx_task = asyncio.create_task(mqtt_rx_coro(rx_q    = mqtt.mqtt_app_rx_q,
+                                                               release = mqtt.release,
+                                                               router  = router))
                     await WaitAny((
                         wifi.is_closed,
                         wifisocket.is_closed,
@@ -99,34 +110,50 @@ async def mqtt_coro(wifi):
             if rx_task:
                 rx_task.cancel()
 
-async def mqtt_rx_coro(rx_q):
+# <root>/ota/<cmd>, see ota.OTAWriter.  OTAWriter on the first ota message,
+# kept for the life of the handler
+def ota_handler(publish):
+    ota = None
+    async def on_ota(r, rest):
+        nonlocal ota
+        cmd = bytes(rest) # bytes already for an interned topic
+        if cmd == b'ack' or cmd == b'nack' or cmd == b'crcs':
+            return # our own replies, a 3.1.1 broker echoes them (no_local is mqtt 5)
+        if ota is None:
+            ota = OTAWriter()
+        try:
+            # r.payload is a memoryview into the rx buffer, ota.PayloadReader
+            # inflates from it in place.  Not io.BytesIO, micropython only
+            # references a bytes/str in place and copies a memoryview.
+            reply = await ota.on_msg(cmd, r.payload)
+            if reply:
+                await publish(topic   = MQTT_ROOT+b'/ota/'+reply[0],
+                              payload = reply[1],
+                              qos     = 0)
+        except Exception as err:
+            sys.print_exception(err)
+        if cmd == b'done' and ota.verified:
+            print('OTA DONE RESETTING@')
+            await asyncio.sleep_ms(1000) # let the ack out
+            machine.reset()
+            # EXIT
+    return on_ota
+
+# messages are zerocopy, topic/payload reference the mqtt rx buffer until
+# released
+async def mqtt_rx_coro(rx_q, release, router):
     part = esp32.Partition(esp32.Partition.RUNNING)
     part.mark_app_valid_cancel_rollback()
-    ota_part = esp32.Partition(esp32.Partition.RUNNING).get_next_update()
-    OTA_BLOCK_SIZE = 4096
     while True:
         try:
             r = await rx_q.get()
             if r:
-                # print('RX',r)
-                tlvls = r.topic.split(b'/')
-                if tlvls[1] == b'ota':
-                    if tlvls[2] == b'done':
-                        print('OTA DONE RESETTING@')
-                        ota_part.set_boot()
-                        machine.reset()
-                        # EXIT
-                    page = int(tlvls[2].decode())
-                    try:
-                        with deflate.DeflateIO(io.BytesIO(r.payload), deflate.ZLIB) as d:
-                            print('wr ota page:{}'.format(page))
-                            b = bytearray(OTA_BLOCK_SIZE)
-                            d.readinto(b)
-                            ota_part.writeblocks(page, b)
-                    except Exception as err:
-                        sys.print_exception(err)
-                else:
-                    print('Unkown message received',r)
+                try:
+                    # print('RX',r)
+                    if not await router.dispatch(r):
+                        print('Unkown message received',r)
+                finally:
+                    release()
         except asyncio.CancelledError:
             raise
         except Exception as err:
@@ -153,40 +180,6 @@ async def ntp_coro():
     except Exception as err:
         sys.print_exception(err)
 
-# colorize and write to neopixel
-async def display_coro(frmmsk, neo):
-    global is_nighttime
-    shift = 0
-    speed = 1
-    try:
-        while True:
-            try:
-                await asyncio.sleep_ms(3)
-                yr, mth, day, hr, min, sec, msec, = lcl_timetuple()
-                shift += speed
-                for i in range(NEOPIXELS_LEN):
-                    x,y = i_to_xy(i)
-                    if is_nighttime:
-                        hue = LED_HUE_PUPLE
-                        val = 1
-                    elif CLOCK_MODE == CELESTE_MODE:
-                        hue = ((x-shift//20)*256)//NEOPIXELS_ROW
-                        val = 5
-                    elif CLOCK_MODE == CALLEN_MODE:
-                        hue = (min*60+sec)*360//(60*60)
-                        val = 5
-                    val = val if frmmsk[i] else 0
-                    neo[i] = hsv_to_rgb(hue, 255, val)
-                neo.write()
-            except asyncio.CancelledError:
-                raise
-            except Exception as err:
-                sys.print_exception(err)
-    except asyncio.CancelledError:
-        raise
-    except Exception as err:
-        sys.print_exception(err)
-
 async def repl_coro():
     sreader = asyncio.StreamReader(sys.stdin.buffer)
     try:
@@ -222,7 +215,7 @@ async def start():
         led_pwr = Pin(_NEOPIXELS_PWR, Pin.OUT, value=1)
         gc_task = asyncio.create_task(gc_coro())
         neo = NeoPixel(Pin(_NEOPIXELS_DAT), NEOPIXELS_LEN)
-        framemask = bytearray(NEOPIXELS_LEN)
+        frame = Frame()
 
         # for x in range(NEOPIXELS_LEN):
             # neo[x] = hsv_to_rgb(LED_HUE_RED, 255, 5)
@@ -231,9 +224,11 @@ async def start():
         # neo.write()
 
         repl_task = asyncio.create_task(repl_coro())
-        clock_task = asyncio.create_task(clock_coro(frmmsk = framemask))
-        display_task = asyncio.create_task(display_coro(frmmsk = framemask,
-                                                        neo = neo))
+        clock_task = asyncio.create_task(clock_coro(frame = frame,
+                                                    mode  = CLOCK_MODE))
+        display_task = asyncio.create_task(display_coro(frame = frame,
+                                                        neo   = neo,
+                                                        mode  = CLOCK_MODE))
 
         while True:
             try:
@@ -3,18 +3,30 @@ import sys
 import asyncio
 import time
 import upydash as _ 
+from micropython import const
 
 from asyncio import Event
 from primitives.delay_ms import Delay_ms
-from lib.priorityqueue import PriorityQueue
+from wifi.levelqueue import LevelQueue
 
 from . import defs as mqtt_defs
 from . import encdec as mqtt_encdec
+from .topics import TopicTable
 
 from lib.debug import DebugMixin
 from lib import byteify_pkt
 from lib import cancel_gather_wait_for_ms
 
+_RX_SPLITS_MAX = const(32) # pkts handled per scan of the rx buffer
+
+# qosacks timing wheel, retries are scheduled into slots of _QOSACKS_TICK_MS
+_QOSACKS_TICK_MS = const(250)
+_QOSACKS_SLOTS   = const(32)  # one lap is 8s, longer deadlines wait out laps
+_QOSACKS_MAX_TIMEOUT_MS = const(60000) # retry backoff cap
+
+_MAX_INFLIGHT = const(16) # qos1 publishes awaiting puback
+_APP_RX_Q_LEN = const(16) # publishes passed up, rx_coro waits when full
+_TOPIC_ALIAS_MAX = const(16) # mqtt 5, aliases the broker may use with us
 
 class MQTTCore(DebugMixin):
     def __init__(self, socket,
@@ -24,6 +36,9 @@ class MQTTCore(DebugMixin):
                        will_topic = None,
                        will_msg   = None,
                        debug      = None,
+                       zerocopy   = False,
+                       max_inflight = _MAX_INFLIGHT,
+                       protocol   = mqtt_defs.PROTOCOL_LEVEL, # PROTOCOL_LEVEL_5 for mqtt 5
                        ):
         self._name  = 'MQTT'
         self._debug = debug
@@ -34,23 +49,47 @@ class MQTTCore(DebugMixin):
         self.will_topic = will_topic
         self.will_msg = will_msg
 
+        self.protocol = protocol
+        self.v5 = protocol == mqtt_defs.PROTOCOL_LEVEL_5
+
         self.socket = socket
 
-        self.rx_q  = self.socket.rx_q
+        self.rx_stream = self.socket.rx_stream
         self.tx_q  = self.socket.tx_q
 
         #APPLICATION LAYER INTERFACE
         #pass messages up to application layer
-        self.mqtt_app_rx_q  = PriorityQueue()
+        self.mqtt_app_rx_q  = LevelQueue(sizes = (_APP_RX_Q_LEN,), item_len = None)
         #application to send messages, use publish/ping/subscribe/etc... directly
 
+        #zerocopy, publishes passed up have memoryview topic/payload into the
+        #rx buffer.  Each one is a lease, the application must call release()
+        #when done with it.  rx_coro won't reuse the buffer until all leases
+        #are released.
+        self.zerocopy = zerocopy
+        self.rx_leases = 0
+        self.rx_released = Event()
+        self.rx_released.set()
+
         self.tasks = []
 
         self.is_closed = Event()
         self.is_closed.set()
 
-        # list of all transmissions that we are expecting an ack for 
-        self.qosacks_table   = []
+        # all transmissions that we are expecting an ack for, by packet_id
+        self.qosacks = {}
+        # timing wheel of the same qosacks by retry deadline.  Acked entries
+        # are left in their slot and skipped when the sweep reaches it.
+        self.qosacks_wheel = [[] for _ in range(_QOSACKS_SLOTS)]
+        self.qosacks_tick  = 0
+
+        # sliding window of qos1 publishes, publish() waits for a slot, a
+        # puback frees it.  mqtt 5, the broker's receive maximum lowers it.
+        self.max_inflight_cfg = max_inflight
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.inflight_space = Event()
+        self.inflight_space.set()
 
         self.packet_id_incr = 0
 
@@ -75,10 +114,30 @@ class MQTTCore(DebugMixin):
         #event for when we receive connack.  context blocks until set
         self.got_connack = Event()
 
+        # mqtt 5, negotiated on connect.  We tell the broker our receive
+        # maximum (mqtt_app_rx_q), maximum packet size (the most the rx
+        # buffer grows to, a v5 broker drops a bigger publish rather than
+        # send it, see tools/pushfw.py) and topic alias maximum.  The
+        # broker's limits on what we send are kept here, None/0 until connack.
+        self.max_pkt_size = None # largest pkt the broker takes
+        self.tx_alias_max = 0    # aliases the broker takes from us
+        self.tx_aliases = {}     # topic -> alias we sent, -alias until its pkt is queued
+        self.tx_alias_next = 1
+        # received topics and the aliases the broker set, shared with the
+        # router (MQTTRouter(topics=mqtt.topics)) so the ids agree
+        self.topics = TopicTable()
+
 
     def set_client_id(self, client_id):
         self.client_id = client_id
 
+    # release a zerocopy publish received from mqtt_app_rx_q
+    def release(self):
+        if self.rx_leases > 0:
+            self.rx_leases -= 1
+        if self.rx_leases == 0:
+            self.rx_released.set()
+
     async def start(self):
         print('start')
         await self.stop_tasks()
@@ -86,9 +145,22 @@ class MQTTCore(DebugMixin):
         #clear connack event
         self.got_connack.clear()
 
-        ## clear qosacks except publishes
-        self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.type == mqtt_defs.PUBLISH)
-        
+        # negotiated again on this connection, aliases don't carry over
+        self.max_inflight = self.max_inflight_cfg
+        self.max_pkt_size = None
+        self.tx_alias_max = 0
+        self.tx_aliases.clear()
+        self.tx_alias_next = 1
+        self.topics.clear_aliases()
+
+        ## clear qosacks except publishes, they are retried on this connection
+        publishes = [qosack for qosack in self.qosacks.values() if qosack.type == mqtt_defs.PUBLISH]
+        self.qosacks.clear()
+        for slot in self.qosacks_wheel:
+            slot.clear()
+        for qosack in publishes:
+            self.qosack_schedule(qosack)
+
         self.tasks.append(asyncio.create_task(self.rx_coro()))
         self.tasks.append(asyncio.create_task(self.qosacks_coro()))
 
@@ -159,62 +231,37 @@ class MQTTCore(DebugMixin):
     async def rx_coro(self):
         try:
             #local access
-            rx_q = self.rx_q
-            rx_q_wait = rx_q.wait
-            rx_q_empty = rx_q.empty
-            rx_q_peek_len = rx_q.peek_len
-            rx_q_get = rx_q.get_nowait
+            rx_stream = self.rx_stream
+            rx_stream_wait = rx_stream.wait
+            rx_stream_consume = rx_stream.consume
             process_pkt = self.process_pkt
-            split_bytes_to_pkts = mqtt_encdec.split_bytes_to_pkts
+            scan_pkts = mqtt_encdec.scan_pkts
+            splits = mqtt_encdec.new_splits(_RX_SPLITS_MAX)
             got_connack = self.got_connack.is_set
             pinger_trigger = self.pinger.trigger
+            zerocopy = self.zerocopy
+            rx_released_wait = self.rx_released.wait
             # watchdog_trigger = self.watchdog.trigger
 
-            #pre-allocate buffer
-            max_len = 1024*5
-            data = bytearray(max_len)
-            mv = memoryview(data)
-
-            idx = 0 #reset index outside of inner loop.  Inner loop idx tracks the residues
             while True: # mqtt protocol level timeout
                 # if got_connack(): #self.got_connack.is_set():
                     # pinger_trigger()
                     # watchdog_trigger()
                 pinger_trigger()
                 # watchdog_trigger()
-                # idx = 0 # don't reset idx, we are keeping the residues
-                itr = 0 # track the iteration
-                await rx_q_wait()
+                # the socket reads straight into rx_stream, residues are kept at the front
+                await rx_stream_wait()
                 while True:
-                    if rx_q_empty():
-                        break
-                    next_len = rx_q_peek_len()
-                    if not next_len:
-                        continue
-                    if itr == 0 and next_len > max_len: #the data is bigger than the buffer -> grow the buffer
-                        max_len = next_len
-                        data = bytearray(max_len)
-                        mv = memoryview(data)
-                    if idx+next_len >= max_len:
-                        break
-
-                    ##################################################
-                    # GET SOCKET RX DATA
-                    # r = rx_q_get()
-                    # print('rx_coro', idx, next_len, idx+next_len, r, len(r))
-                    # mv[idx:idx+next_len] = r
-                    mv[idx:idx+next_len] = rx_q_get()
-                    ##################################################
-
-                    idx += next_len
-                    itr += 1
-                # print('rx', idx)
-                (pkt_splits, buff_from,) = split_bytes_to_pkts(mv[:idx])
-                for pkt_split in pkt_splits:
-                    await process_pkt(pkt = mv[pkt_split[0]:pkt_split[1]])
-                # print(idx, buff_from, idx-buff_from)
-                mv[0:idx-buff_from] = mv[buff_from:idx] #copy residue to front of buffer
-                idx = idx-buff_from # update idx to account for residue
+                    mv = rx_stream.mv # changes if the stream grows
+                    buff_from = scan_pkts(mv, rx_stream.idx, splits)
+                    cnt = splits[0]
+                    for k in range(1, 1+2*cnt, 2):
+                        await process_pkt(pkt = mv[splits[k]:splits[k+1]])
+                    if zerocopy:
+                        await rx_released_wait() # app is done with the buffer
+                    rx_stream_consume(buff_from) # move residue to front of buffer
+                    if cnt < _RX_SPLITS_MAX:
+                        break # otherwise splits was full, scan the residue
 
         except asyncio.CancelledError:
             raise
@@ -227,7 +274,7 @@ class MQTTCore(DebugMixin):
         try:
             # self.debug('process_pkt', len(pkt), bytes(pkt))
             try:
-                mqtt_struct = mqtt_encdec.decode(pkt)
+                mqtt_struct = mqtt_encdec.decode(pkt, self.zerocopy, self.v5)
             except asyncio.CancelledError:
                 raise
             except Exception as err:
@@ -237,83 +284,131 @@ class MQTTCore(DebugMixin):
             if mqtt_struct.type == mqtt_defs.PUBLISH:
                 # self.debug('rx', 'PUBLISH', mqtt_struct)
                 # self.debug('rx', 'PUBLISH')
+                msg = mqtt_struct.obj
+                if msg.topic_alias:
+                    msg = self.resolve_alias(msg)
+                    if msg is None:
+                        return
 
                 ##################################################
                 # Passing RX DATA up to MQTT ROOM/LOBBY
-                await self.mqtt_app_rx_q.put(mqtt_struct.obj)
+                if self.zerocopy:
+                    self.rx_leases += 1
+                    self.rx_released.clear()
+                await self.mqtt_app_rx_q.put(msg)
                 ##################################################
 
-                if mqtt_struct.obj.qos == 1: #PUBACK for qos==1
+                if msg.qos == 1: #PUBACK for qos==1
                     # print('publish qos==1', 'respond with PUBACK')
-                    await self.puback(packet_id = mqtt_struct.obj.packet_id)
+                    await self.puback(packet_id = msg.packet_id)
             elif mqtt_struct.type == mqtt_defs.CONNACK:
                 self.debug('rx','CONNACK', hex(mqtt_struct.obj.return_code),
-                            mqtt_defs.connack_to_string(mqtt_struct.obj.return_code))
+                            mqtt_defs.connack_to_string(mqtt_struct.obj.return_code, self.v5))
                 if mqtt_struct.obj.return_code == mqtt_defs.CONNACK_RETURN_CODE_SUCCESS:
+                    if self.v5:
+                        self.negotiate(mqtt_struct.obj.properties)
                     self.got_connack.set()
             elif mqtt_struct.type == mqtt_defs.PUBACK:
-                # self.debug('rx', 'PUBACK', mqtt_struct, self.qosacks_table, mqtt_struct.obj.packet_id)
-                qosack = _.find(self.qosacks_table, lambda qosack: qosack.packet_id == mqtt_struct.obj.packet_id)
-                self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.packet_id != mqtt_struct.obj.packet_id)
-                qosack.event.set()
+                # self.debug('rx', 'PUBACK', mqtt_struct, mqtt_struct.obj.packet_id)
+                if mqtt_struct.obj.reason_code >= 0x80:
+                    self.debug('rx', 'PUBACK', mqtt_struct.obj.packet_id,
+                               mqtt_defs.reason_to_string(mqtt_struct.obj.reason_code))
+                self.qosack_done(mqtt_struct.obj.packet_id)
             elif mqtt_struct.type == mqtt_defs.SUBACK:
                 self.debug('rx', 'SUBACK', mqtt_struct)
-                qosack = _.find(self.qosacks_table, lambda qosack: qosack.packet_id == mqtt_struct.obj.packet_id)
-                self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.packet_id != mqtt_struct.obj.packet_id)
-                qosack.event.set()
+                self.qosack_done(mqtt_struct.obj.packet_id)
             elif mqtt_struct.type == mqtt_defs.UNSUBACK:
                 self.debug('rx', 'UNSUBACK', mqtt_struct)
-                qosack = _.find(self.qosacks_table, lambda qosack: qosack.packet_id == mqtt_struct.obj.packet_id)
-                self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.packet_id != mqtt_struct.obj.packet_id)
-                qosack.event.set()
+                self.qosack_done(mqtt_struct.obj.packet_id)
             elif mqtt_struct.type == mqtt_defs.PINGRESP:
                 self.ping_delay_ms = time.ticks_diff(time.ticks_ms(), self.ping_ticks_start)
                 self.debug('rx', 'PINGRESP', self.ping_delay_ms,'ms')
+            elif mqtt_struct.type == mqtt_defs.DISCONNECT:
+                # mqtt 5, the broker is closing the connection
+                self.debug('rx', 'DISCONNECT', mqtt_defs.reason_to_string(mqtt_struct.obj.reason_code))
+                self.is_closed.set()
         except asyncio.CancelledError:
             raise
         except Exception as err:
             sys.print_exception(err)
 
-    # Check QosAcks table for any messages that have timedout and try them again
+    # mqtt 5 connack properties, the broker's limits on this connection
+    def negotiate(self, props):
+        if props is None:
+            props = {}
+        receive_max = props.get(mqtt_defs.PROP_RECEIVE_MAXIMUM, mqtt_defs.RECEIVE_MAXIMUM_DEFAULT)
+        self.max_inflight = min(self.max_inflight_cfg, receive_max)
+        if self.inflight < self.max_inflight:
+            self.inflight_space.set()
+        self.max_pkt_size = props.get(mqtt_defs.PROP_MAXIMUM_PACKET_SIZE)
+        self.tx_alias_max = props.get(mqtt_defs.PROP_TOPIC_ALIAS_MAXIMUM, 0)
+        self.debug('negotiated', 'inflight', self.max_inflight,
+                   'max pkt', self.max_pkt_size, 'aliases', self.tx_alias_max)
+
+    # mqtt 5 publish with a topic alias.  With a topic the alias is set to
+    # it, without one the alias gives the topic.  The publish is returned
+    # with the topic (bytes) and its topic id, None for an unknown alias,
+    # a protocol error that closes the connection.
+    def resolve_alias(self, msg):
+        topics = self.topics
+        if len(msg.topic):
+            tid = topics.set_alias(msg.topic_alias, msg.topic)
+        else:
+            tid = topics.alias(msg.topic_alias)
+            if tid < 0:
+                self.debug('rx', 'PUBLISH', 'unknown topic alias', msg.topic_alias)
+                self.is_closed.set()
+                return None
+        return mqtt_defs.Publish_struct(
+            packet_id   = msg.packet_id,
+            qos         = msg.qos,
+            topic       = topics.topic(tid),
+            payload     = msg.payload,
+            topic_alias = msg.topic_alias,
+            topic_id    = tid,
+        )
+
+    # add to the in flight table, retry if not acked within timeout_ms
+    def qosack_schedule(self, qosack):
+        qosack.stamp = time.ticks_ms()
+        qosack.deadline = self.qosacks_tick + max(1, (qosack.timeout_ms+_QOSACKS_TICK_MS-1)//_QOSACKS_TICK_MS)
+        self.qosacks[qosack.packet_id] = qosack
+        self.qosacks_wheel[qosack.deadline % _QOSACKS_SLOTS].append(qosack)
+
+    # got the ack
+    def qosack_done(self, packet_id):
+        qosack = self.qosacks.pop(packet_id, None)
+        if qosack:
+            qosack.event.set()
+            if qosack.type == mqtt_defs.PUBLISH:
+                self.inflight -= 1
+                self.inflight_space.set()
+
+    # Advance the QosAcks wheel, retry messages in the slot that have timedout
     async def qosacks_coro(self):
         #local access optimization
-        publish = self.publish
-        subscribe = self.subscribe
-        unsubscribe = self.unsubscribe
         sleep_ms = asyncio.sleep_ms
-        ticks_ms = time.ticks_ms
-        ticks_diff = time.ticks_diff
-        _timeout_ms = mqtt_defs.QOS_ACKS_TIMEOUT_MS
+        qosacks = self.qosacks
+        wheel = self.qosacks_wheel
+        qosack_expired = self.qosack_expired
 
         try:
             while True:
-                await sleep_ms(_timeout_ms)
-                now = ticks_ms()
-                # get expired
-                expireds           = _.filter(self.qosacks_table, lambda qosack: ticks_diff(now, qosack.stamp) >= _timeout_ms)
-                # get ids
-                expired_ids = _.map(expireds, lambda qosack: qosack.packet_id)
-                # remove all expired from table
-                self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.packet_id not in expired_ids)
-
-                for qosack in expireds:
-                    if qosack.type == mqtt_defs.PUBLISH:
-                        await publish(pkt       = qosack.pkt,
-                                    packet_id = qosack.packet_id,
-                                    try_count = qosack.try_count + 1,
-                                    )
-                    if qosack.type == mqtt_defs.SUBSCRIBE:
-                        print('qosacks', 'SUBSCRIBE FAIL')
-                        # await subscribe(pkt       = qosack.pkt,
-                                        # packet_id = qosack.packet_id,
-                                        # try_count = qosack.try_count + 1,
-                                        # )
-                    if qosack.type == mqtt_defs.UNSUBSCRIBE:
-                        pass
-                        # await unsubscribe(pkt       = qosack.pkt,
-                                        # packet_id = qosack.packet_id,
-                                        # try_count = qosack.try_count + 1,
-                                        # )
+                await sleep_ms(_QOSACKS_TICK_MS)
+                self.qosacks_tick += 1
+                tick = self.qosacks_tick
+                idx = tick % _QOSACKS_SLOTS
+                slot = wheel[idx]
+                if not slot:
+                    continue
+                wheel[idx] = []
+                for qosack in slot:
+                    if qosacks.get(qosack.packet_id) is not qosack:
+                        continue # acked, drop from wheel
+                    if qosack.deadline > tick:
+                        wheel[idx].append(qosack) # due on a later lap
+                        continue
+                    await qosack_expired(qosack)
 
         except asyncio.CancelledError:
             raise
@@ -322,12 +417,27 @@ class MQTTCore(DebugMixin):
         finally:
             self.is_closed.set()
 
+    async def qosack_expired(self, qosack):
+        if qosack.type == mqtt_defs.PUBLISH:
+            # same entry and event, callers awaiting it see the final ack
+            qosack.try_count += 1
+            qosack.timeout_ms = min(qosack.timeout_ms*2, _QOSACKS_MAX_TIMEOUT_MS) # backoff
+            if isinstance(qosack.pkt, bytearray):
+                qosack.pkt[0] |= 0x08 # DUP, re-delivery
+            self.qosack_schedule(qosack)
+            await self.tx_q.put(qosack.pkt) #self.socket.tx_q
+            return
+        del self.qosacks[qosack.packet_id]
+        if qosack.type == mqtt_defs.SUBSCRIBE:
+            print('qosacks', 'SUBSCRIBE FAIL')
+        # UNSUBSCRIBE, drop
+
     # @micropython.native
     def next_packet_id(self):
+        qosacks = self.qosacks
         while True:
             self.packet_id_incr = (self.packet_id_incr+1)%65536
-            has_packet_id = _.find(self.qosacks_table, lambda qosack: qosack.packet_id == self.packet_id_incr)
-            if has_packet_id == None:
+            if self.packet_id_incr and self.packet_id_incr not in qosacks: # 0 isn't a valid id
                 break
         return self.packet_id_incr
 
@@ -338,21 +448,40 @@ class MQTTCore(DebugMixin):
                             packet_id = None,  #
                             try_count = 1,     #
                             pkt       = None,  # if we already have the pkt (re-posting) topic/payload/qos included
+                            timeout_ms = mqtt_defs.QOS_ACKS_TIMEOUT_MS, # first retry, doubles each retry
                             ):
         if payload != None:
             payload = byteify_pkt(payload)
         if payload == None or len(payload) == 0 and pkt == None:
             return
+        if qos > 0:
+            # wait for a slot in the inflight window
+            while self.inflight >= self.max_inflight:
+                self.inflight_space.clear()
+                await self.inflight_space.wait()
         if packet_id == None and qos != 0:
             packet_id = self.next_packet_id()
+        sets_alias = None # topic whose alias this pkt sets
         if pkt == None:
+            topic_alias = 0
+            if qos == 0 and self.tx_alias_max:
+                (tx_topic, topic_alias) = self.tx_alias(topic)
+                if topic_alias and tx_topic:
+                    sets_alias = topic
+                topic = tx_topic
             pkt = mqtt_encdec.encode_publish(topic     = topic,
                                                      payload   = payload,
                                                      packet_id = packet_id,
                                                      dupe      = try_count > 1,
                                                      retain    = retain,
                                                      qos       = qos,
+                                                     v5        = self.v5,
+                                                     topic_alias = topic_alias,
                                                      )
+        if self.max_pkt_size and len(pkt) > self.max_pkt_size:
+            # the broker would close the connection over it.  Nothing is
+            # recorded yet, a new alias is only taken once its pkt is queued.
+            raise ValueError('publish too large, {} > {}'.format(len(pkt), self.max_pkt_size))
         #pkt = b'0\x13\x00\x06ib0/up\x10\x00\x00\x00\x01\x00\x00\x03\xfe\x00\x11'
         if qos > 0:
             #only add to qos ack if we are qos>=1
@@ -363,20 +492,59 @@ class MQTTCore(DebugMixin):
                 pkt       = pkt,
                 packet_id = packet_id,
                 event     = Event(),
+                timeout_ms = timeout_ms,
             )
-            self.qosacks_table.append(qosack)
+            self.qosack_schedule(qosack)
+            self.inflight += 1
 
         self.pinger.trigger() # should we do pinger on pub?
 
-        await self.tx_q.put(pkt) #self.socket.tx_q
+        if sets_alias:
+            # the broker must see the pkt setting an alias before any that
+            # use it, it's queued to wait for room and never dropped.  Until
+            # it is, publishes to the topic go without the alias.
+            alias = topic_alias
+            self.tx_aliases[sets_alias] = -alias
+            self.tx_alias_next += 1
+            try:
+                await self.tx_q.put(pkt) #self.socket.tx_q
+            except:
+                del self.tx_aliases[sets_alias]
+                raise
+            self.tx_aliases[sets_alias] = alias
+        elif qos == 0:
+            # never waits, past the tx_q budget the oldest queued qos0
+            # publishes are dropped (counted in tx_q.dropped)
+            try:
+                self.tx_q.put_nowait(pkt, drop_oldest=True) #self.socket.tx_q
+            except IndexError:
+                pass
+        else:
+            await self.tx_q.put(pkt) #self.socket.tx_q
         if qos > 0:
             return qosack
 
+    # mqtt 5 topic alias for a qos0 publish, (topic, alias) to send.  The
+    # first publish to a topic sets the alias, later ones send an empty
+    # topic.  Only qos0 is aliased, a qos1 pkt may be resent on the next
+    # connection where the alias means nothing.  Only looks, publish()
+    # records a new alias once the pkt setting it is queued.
+    def tx_alias(self, topic):
+        if not isinstance(topic, (bytes, str)): # hashable
+            return (topic, 0)
+        alias = self.tx_aliases.get(topic)
+        if alias:
+            return (b'', alias) if alias > 0 else (topic, 0) # < 0, its pkt isn't queued yet
+        if self.tx_alias_next > self.tx_alias_max:
+            return (topic, 0)
+        return (topic, self.tx_alias_next)
+
     async def subscribe(self, topics,
                               qoss      = 1,
                               packet_id = None,  #
                               try_count = 1,     #
                               pkt       = None,  # if we already have the pkt (re-posting) topic/payload/qos included
+                              no_local  = False, # mqtt 5, not our own publishes
                         ):
         if len(topics) == 0 and pkt == None:
             return
@@ -386,6 +554,8 @@ class MQTTCore(DebugMixin):
             topic_qoss = _.map(topics, lambda topic: (topic, qoss))
             pkt = mqtt_encdec.encode_subscribe(topic_qoss,
                                                packet_id = packet_id,
+                                               v5        = self.v5,
+                                               no_local  = no_local,
                                               )
         print('tx', 'SUBSCRIBE', topics)
         if qoss > 0:
@@ -397,8 +567,9 @@ class MQTTCore(DebugMixin):
                 packet_id = packet_id,
                 event     = Event(),
             )
-            self.qosacks_table.append(qosack)
+            self.qosack_schedule(qosack)
         await self.tx_q.put(pkt, is_priority=True) #self.socket.tx_q
+        self.socket.flush() # control pkt, don't wait for coalescing
         if qoss > 0:
             return qosack
 
@@ -414,6 +585,7 @@ class MQTTCore(DebugMixin):
         if pkt == None:
             pkt = mqtt_encdec.encode_unsubscribe(topics,
                                                          packet_id = packet_id,
+                                                         v5        = self.v5,
                                                          )
         # print('tx', 'UNSUBSCRIBE', topics)
         # always get unsuback
@@ -425,8 +597,9 @@ class MQTTCore(DebugMixin):
             packet_id = packet_id,
             event     = Event(),
         )
-        self.qosacks_table.append(qosack)
+        self.qosack_schedule(qosack)
         await self.tx_q.put(pkt, is_priority=True) #self.socket.tx_q
+        self.socket.flush() # control pkt, don't wait for coalescing
         return qosack
 
     async def puback(self, packet_id):
@@ -447,6 +620,7 @@ class MQTTCore(DebugMixin):
             print('pingreq')
             self.ping_ticks_start = time.ticks_ms()
             await self.tx_q.put(pkt, is_priority=True) #self.socket.tx_q
+            self.socket.flush() # control pkt, don't wait for coalescing
 
     async def _connect(self, username   = None,
                              password   = None,
@@ -454,6 +628,13 @@ class MQTTCore(DebugMixin):
                              will_msg   = None,
                              ):
         print('CONNECT', 'client_id', self.client_id)
+        properties = None
+        if self.v5:
+            properties = [
+                (mqtt_defs.PROP_RECEIVE_MAXIMUM,     _APP_RX_Q_LEN),
+                (mqtt_defs.PROP_MAXIMUM_PACKET_SIZE, self.rx_stream.max_size),
+                (mqtt_defs.PROP_TOPIC_ALIAS_MAXIMUM, _TOPIC_ALIAS_MAX),
+            ]
         pkt = mqtt_encdec.encode_connect(client_id     = self.client_id,
                                          keep_alive    = mqtt_defs.KEEP_ALIVE_S,
                                          clean_session = True,
@@ -461,12 +642,16 @@ class MQTTCore(DebugMixin):
                                          password      = password,
                                          will_topic    = will_topic,
                                          will_msg      = will_msg,
+                                         protocol_level = self.protocol,
+                                         properties    = properties,
                                          )
         # print('CONNECT')
         # self.pinger.trigger()
         await self.tx_q.put(pkt, is_priority=True) #self.socket.tx_q
+        self.socket.flush() # control pkt, don't wait for coalescing
 
     async def disconnect(self):
         pkt = mqtt_encdec.encode_disconnect()
         # print('tx', 'DISCONNET', pkt)
         await self.tx_q.put(pkt, is_priority=True) #self.socket.tx_q
+        self.socket.flush() # control pkt, don't wait for coalescing
@@ -15,7 +15,8 @@ QOS_ACKS_TIMEOUT_MS = const(5000)
 KEEP_ALIVE_S = const(30) # connect keep alive (s)
 
 CONNECT_HEADER = b'\x00\x04MQTT'
-PROTOCOL_LEVEL = const(0x04)
+PROTOCOL_LEVEL   = const(0x04) # 3.1.1
+PROTOCOL_LEVEL_5 = const(0x05) # 5, properties and reason codes
 
 # Fixed header message types
 CONNECT     = const(0x10)
@@ -30,6 +31,76 @@ PINGREQ     = const(0xc0)
 PINGRESP    = const(0xd0)
 DISCONNECT  = const(0xe0)
 
+# mqtt 5 properties, by id
+PROP_PAYLOAD_FORMAT            = const(0x01) # byte
+PROP_MESSAGE_EXPIRY            = const(0x02) # 4 bytes
+PROP_CONTENT_TYPE              = const(0x03) # string
+PROP_RESPONSE_TOPIC            = const(0x08) # string
+PROP_CORRELATION_DATA          = const(0x09) # binary
+PROP_SUBSCRIPTION_ID           = const(0x0b) # variable byte int
+PROP_SESSION_EXPIRY            = const(0x11) # 4 bytes
+PROP_ASSIGNED_CLIENT_ID        = const(0x12) # string
+PROP_SERVER_KEEP_ALIVE         = const(0x13) # 2 bytes
+PROP_AUTH_METHOD               = const(0x15) # string
+PROP_AUTH_DATA                 = const(0x16) # binary
+PROP_REQUEST_PROBLEM_INFO      = const(0x17) # byte
+PROP_WILL_DELAY                = const(0x18) # 4 bytes
+PROP_REQUEST_RESPONSE_INFO     = const(0x19) # byte
+PROP_RESPONSE_INFO             = const(0x1a) # string
+PROP_SERVER_REFERENCE          = const(0x1c) # string
+PROP_REASON_STRING             = const(0x1f) # string
+PROP_RECEIVE_MAXIMUM           = const(0x21) # 2 bytes
+PROP_TOPIC_ALIAS_MAXIMUM       = const(0x22) # 2 bytes
+PROP_TOPIC_ALIAS               = const(0x23) # 2 bytes
+PROP_MAXIMUM_QOS               = const(0x24) # byte
+PROP_RETAIN_AVAILABLE          = const(0x25) # byte
+PROP_USER_PROPERTY             = const(0x26) # string pair
+PROP_MAXIMUM_PACKET_SIZE       = const(0x27) # 4 bytes
+PROP_WILDCARD_SUB_AVAILABLE    = const(0x28) # byte
+PROP_SUBSCRIPTION_ID_AVAILABLE = const(0x29) # byte
+PROP_SHARED_SUB_AVAILABLE      = const(0x2a) # byte
+
+# property value types
+PROP_TYPE_BYTE   = const(1)
+PROP_TYPE_U16    = const(2)
+PROP_TYPE_U32    = const(3)
+PROP_TYPE_VARINT = const(4)
+PROP_TYPE_STR    = const(5)
+PROP_TYPE_BIN    = const(6)
+PROP_TYPE_PAIR   = const(7)
+
+PROP_TYPES = {
+    PROP_PAYLOAD_FORMAT            : PROP_TYPE_BYTE,
+    PROP_MESSAGE_EXPIRY            : PROP_TYPE_U32,
+    PROP_CONTENT_TYPE              : PROP_TYPE_STR,
+    PROP_RESPONSE_TOPIC            : PROP_TYPE_STR,
+    PROP_CORRELATION_DATA          : PROP_TYPE_BIN,
+    PROP_SUBSCRIPTION_ID           : PROP_TYPE_VARINT,
+    PROP_SESSION_EXPIRY            : PROP_TYPE_U32,
+    PROP_ASSIGNED_CLIENT_ID        : PROP_TYPE_STR,
+    PROP_SERVER_KEEP_ALIVE         : PROP_TYPE_U16,
+    PROP_AUTH_METHOD               : PROP_TYPE_STR,
+    PROP_AUTH_DATA                 : PROP_TYPE_BIN,
+    PROP_REQUEST_PROBLEM_INFO      : PROP_TYPE_BYTE,
+    PROP_WILL_DELAY                : PROP_TYPE_U32,
+    PROP_REQUEST_RESPONSE_INFO     : PROP_TYPE_BYTE,
+    PROP_RESPONSE_INFO             : PROP_TYPE_STR,
+    PROP_SERVER_REFERENCE          : PROP_TYPE_STR,
+    PROP_REASON_STRING             : PROP_TYPE_STR,
+    PROP_RECEIVE_MAXIMUM           : PROP_TYPE_U16,
+    PROP_TOPIC_ALIAS_MAXIMUM       : PROP_TYPE_U16,
+    PROP_TOPIC_ALIAS               : PROP_TYPE_U16,
+    PROP_MAXIMUM_QOS               : PROP_TYPE_BYTE,
+    PROP_RETAIN_AVAILABLE          : PROP_TYPE_BYTE,
+    PROP_USER_PROPERTY             : PROP_TYPE_PAIR,
+    PROP_MAXIMUM_PACKET_SIZE       : PROP_TYPE_U32,
+    PROP_WILDCARD_SUB_AVAILABLE    : PROP_TYPE_BYTE,
+    PROP_SUBSCRIPTION_ID_AVAILABLE : PROP_TYPE_BYTE,
+    PROP_SHARED_SUB_AVAILABLE      : PROP_TYPE_BYTE,
+}
+
+RECEIVE_MAXIMUM_DEFAULT = const(65535) # absent from connack
+
 QOS_0 = const(0) # send only
 QOS_1 = const(1) # receive puback
 QOS_2 = const(2)
@@ -69,7 +140,61 @@ CONNACK_RETURN_CODE_ERR_ID_REJECTED = const(0x02)
 CONNACK_RETURN_CODE_ERR_SERVER_DOWN = const(0x03)
 CONNACK_RETURN_CODE_ERR_BAD_AUTH    = const(0x04)
 CONNACK_RETURN_CODE_ERR_NOT_AUTH    = const(0x05)
-def connack_to_string(code):
+# mqtt 5 reason codes, >= 0x80 is a failure.  Connack return codes above
+# are 3.1.1 only.
+REASON_SUCCESS                 = const(0x00)
+REASON_NO_MATCHING_SUBSCRIBERS = const(0x10)
+REASON_UNSPECIFIED_ERROR       = const(0x80)
+REASON_MALFORMED_PACKET        = const(0x81)
+REASON_PROTOCOL_ERROR          = const(0x82)
+REASON_IMPLEMENTATION_ERROR    = const(0x83)
+REASON_UNSUPPORTED_PROTOCOL    = const(0x84)
+REASON_CLIENT_ID_INVALID       = const(0x85)
+REASON_BAD_AUTH                = const(0x86)
+REASON_NOT_AUTHORIZED          = const(0x87)
+REASON_SERVER_UNAVAILABLE      = const(0x88)
+REASON_SERVER_BUSY             = const(0x89)
+REASON_KEEP_ALIVE_TIMEOUT      = const(0x8d)
+REASON_SESSION_TAKEN_OVER      = const(0x8e)
+REASON_TOPIC_FILTER_INVALID    = const(0x8f)
+REASON_TOPIC_NAME_INVALID      = const(0x90)
+REASON_RECEIVE_MAX_EXCEEDED    = const(0x93)
+REASON_TOPIC_ALIAS_INVALID     = const(0x94)
+REASON_PACKET_TOO_LARGE        = const(0x95)
+REASON_QUOTA_EXCEEDED          = const(0x97)
+REASON_PAYLOAD_FORMAT_INVALID  = const(0x99)
+REASON_QOS_NOT_SUPPORTED       = const(0x9b)
+
+_REASON_STRINGS = {
+    REASON_SUCCESS                 : 'success',
+    REASON_NO_MATCHING_SUBSCRIBERS : 'no subscribers',
+    REASON_UNSPECIFIED_ERROR       : 'unspecified',
+    REASON_MALFORMED_PACKET        : 'malformed',
+    REASON_PROTOCOL_ERROR          : 'proto err',
+    REASON_IMPLEMENTATION_ERROR    : 'impl err',
+    REASON_UNSUPPORTED_PROTOCOL    : 'unsupported proto',
+    REASON_CLIENT_ID_INVALID       : 'clientid rej',
+    REASON_BAD_AUTH                : 'bad auth',
+    REASON_NOT_AUTHORIZED          : 'not authorized',
+    REASON_SERVER_UNAVAILABLE      : 'server down',
+    REASON_SERVER_BUSY             : 'server busy',
+    REASON_KEEP_ALIVE_TIMEOUT      : 'keep alive timeout',
+    REASON_SESSION_TAKEN_OVER      : 'session taken over',
+    REASON_TOPIC_FILTER_INVALID    : 'bad topic filter',
+    REASON_TOPIC_NAME_INVALID      : 'bad topic',
+    REASON_RECEIVE_MAX_EXCEEDED    : 'receive max exceeded',
+    REASON_TOPIC_ALIAS_INVALID     : 'bad topic alias',
+    REASON_PACKET_TOO_LARGE        : 'packet too large',
+    REASON_QUOTA_EXCEEDED          : 'quota exceeded',
+    REASON_PAYLOAD_FORMAT_INVALID  : 'bad payload format',
+    REASON_QOS_NOT_SUPPORTED       : 'qos not supported',
+}
+def reason_to_string(code):
+    return _REASON_STRINGS.get(code, hex(code))
+
+def connack_to_string(code, v5=False):
+    if v5:
+        return reason_to_string(code)
     if code == CONNACK_RETURN_CODE_SUCCESS:
         return 'success'
     elif code == CONNACK_RETURN_CODE_ERR_PROTOCOL:
@@ -84,25 +209,32 @@ def connack_to_string(code):
         return 'not authorized'
 
 
+# properties is a dict of property id -> value (mqtt 5), None for 3.1.1
 ConnAck_struct = collections.namedtuple('ConnAck_struct',
     [
         'session_present',
         'return_code',
+        'properties',
     ]
 )
 
+# topic_alias is the mqtt 5 topic alias, 0 for none.  topic_id is the
+# interned id of topic (mqtt.topics), -1 if not interned yet.
 Publish_struct = collections.namedtuple('Pub_struct',
     [
         'packet_id',
         'qos',
         'topic',
         'payload',
+        'topic_alias',
+        'topic_id',
     ]
 )
 
 PubAck_struct = collections.namedtuple('PubAck_struct',
     [
         'packet_id',
+        'reason_code',
     ]
 )
 
@@ -120,22 +252,40 @@ UnsubAck_struct = collections.namedtuple('UnsubAck_struct',
     ]
 )
 
-Mqtt_struct = collections.namedtuple('Mqtt_struct',
+Disconnect_struct = collections.namedtuple('Disconnect_struct',
     [
-        'type',
-        'obj',
+        'reason_code',
+        'properties',
     ]
 )
 
-#keep track of sent items so we can retry if we don't get an ack
-QOSAck = collections.namedtuple('QOSAck',
+Mqtt_struct = collections.namedtuple('Mqtt_struct',
     [
         'type',
-        'stamp',
-        'try_count',
-        'pkt',
-        'packet_id',
-        'event',
+        'obj',
     ]
 )
 
+#keep track of sent items so we can retry if we don't get an ack
+#mutable, the same entry (and event) is kept across retries
+class QOSAck:
+    def __init__(self, type,
+                       stamp,
+                       try_count,
+                       pkt,
+                       packet_id,
+                       event,
+                       deadline   = 0, # qosacks wheel tick to retry at
+                       timeout_ms = QOS_ACKS_TIMEOUT_MS, # until the next retry
+                       ):
+        self.type      = type
+        self.stamp     = stamp
+        self.try_count = try_count
+        self.pkt       = pkt
+        self.packet_id = packet_id
+        self.event     = event
+        self.deadline  = deadline
+        self.timeout_ms = timeout_ms
+    def __repr__(self):
+        return 'QOSAck(type={}, packet_id={}, try_count={})'.format(hex(self.type), self.packet_id, self.try_count)
+
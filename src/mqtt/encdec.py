@@ -4,6 +4,7 @@ try:
     import upydash as _ 
     import random
     from lib.b62 import _BASE62
+    import micropython
     from micropython import const
     IS_UPY = 1
 except ImportError:
@@ -16,8 +17,11 @@ except ImportError:
 
 import struct
 import binascii
+from array import array
 from . import defs as mqtt_defs
 
+_native = micropython.native if IS_UPY else (lambda f: f)
+
 
 #APPLICATION LEVEL
 # CONNECT -> CONNACK (client_id required)
@@ -33,54 +37,88 @@ from . import defs as mqtt_defs
 # https://docs.solace.com/API/MQTT-311-Prtl-Conformance-Spec/MQTT%20Control%20Packets.htm
 
 
-#sockets outputting a stream of bytes, split bytes into pkts + remainder
+# valid first byte of a fixed header, indexed by byte
+# we need to allow lower nibble in publish (qos, dup, retain fields may be set)
+# we need to allow the lower reserved bit in sub and unsub
+def _gen_header_lut():
+    lut = bytearray(256)
+    for b in range(256):
+        t = b & 0xf0
+        if b in (mqtt_defs.CONNECT, mqtt_defs.CONNACK, mqtt_defs.PUBACK,
+                 mqtt_defs.SUBSCRIBE, mqtt_defs.SUBACK,
+                 mqtt_defs.UNSUBSCRIBE, mqtt_defs.UNSUBACK,
+                 mqtt_defs.PINGREQ, mqtt_defs.PINGRESP,
+                 mqtt_defs.DISCONNECT) or\
+           t == mqtt_defs.PUBLISH or\
+           t == mqtt_defs.SUBSCRIBE   and b&0x02 or\
+           t == mqtt_defs.UNSUBSCRIBE and b&0x02:
+            lut[b] = 1
+    return bytes(lut)
+_HEADER_LUT = _gen_header_lut()
+
+# splits array for scan_pkts, room for max_pkts (start,end) pairs
+def new_splits(max_pkts):
+    return array('H', [0]*(1+2*max_pkts))
+
+#sockets outputting a stream of bytes, split the first n bytes into pkts + remainder
+#single pass, no allocations.  Packet offsets are written into splits, an
+#array('H') from new_splits:
+#   splits[0]        number of pkts found
+#   splits[1+2*k]    start of pkt k
+#   splits[2+2*k]    end of pkt k
+#returns the offset of the first unconsumed byte (start of the residue).
+#Stops early when splits is full, call again from the residue.
+#Offsets are 16 bit, n must be < 65536.
 #from mqtt.encdec import *
 #a=bytes([0x90,0x3,0xcb,0x58,0x1])
 #a=bytes([0x31,0x17,0x00,0x0a,0x69,0x62,0x30,0x2f,0x64,0x65,0x76,0x2f,0x64,0x6e,0x82,0xe0,0x74,0xe5,0xd4,0x00,0x00,0x00,0x00,0x01,0x9f])
 #a=bytes([0x90,0x3,0xcb,0x58,0x1,0x90,0x3,0xcb,0x58,0x1,0x90,0x3,0xcb,0x58,0x1,0x90,0x3,0xcb,0x58,0x1,0x90,0x3,0xcb,0x58,0x1,0x90,0x3,0xcb,0x58,0x1,0x90,0x3,0xcb])
-#split_bytes_to_pkts(a)
+#s=new_splits(8); scan_pkts(a, len(a), s); s
 #encode_subscribe([('time/lcltime',0,)],)
-# @micropython.native
-def split_bytes_to_pkts(mv):
-    #mv = memoryview(buff)
+@_native
+def scan_pkts(mv, n, splits):
+    lut = _HEADER_LUT
+    end_splits = len(splits)
+    cnt = 0
+    o = 1
     i = 0
-    headers = [mqtt_defs.CONNECT, mqtt_defs.CONNACK, mqtt_defs.PUBLISH, mqtt_defs.PUBACK, 
-               mqtt_defs.SUBSCRIBE, mqtt_defs.SUBACK, 
-               mqtt_defs.UNSUBSCRIBE, mqtt_defs.UNSUBACK, 
-               mqtt_defs.PINGREQ, mqtt_defs.PINGRESP]
-    do_break = False
-    lenbuff = len(mv)
-    pkt_splits = []
-    while i < lenbuff and not do_break:  #two bytes is the minimum mqtt message length 
-        if mv[i] in headers or\
-           mv[i]&0xf0 == mqtt_defs.PUBLISH or\
-           mv[i]&0xf0 == mqtt_defs.SUBSCRIBE   and mv[i]&0x02 or\
-           mv[i]&0xf0 == mqtt_defs.UNSUBSCRIBE and mv[i]&0x02:
-            # we need to allow lower nibble in publish (qos, dup, retain fields may be set)
-            # we need to allow the lower reserved bit in sub and unsub
-
-            # print('found header '+hex(mv[i]))
-            (remaining_length, k) = decode_remaining_length(mv[i+1:i+1+4])
-            # print('remaining_length', remaining_length, 'k', k)
-            if remaining_length!=None and k!=None:
-                # print('i+k+remaining_length', i+k+remaining_length, 'lenbuff', lenbuff)
-                if i+k+remaining_length < lenbuff:
-                    #we have all the bytes here
-                    pkt_splits.append((i,i+k+remaining_length+1)) #split tuple
-                    i += k+remaining_length+1
-                else:
-                    #we need more bytes
-                    do_break = True
-                    break
-            else:
-                if len(mv[i+1:i+1+4]) < 4:
-                    #we need more bytes, remaining length is truncated
-                    do_break = True
-                    break
-                else:
-                    i += 1
-        else:
+    while i < n and o < end_splits:
+        if not lut[mv[i]]:
             i += 1
+            continue
+        #remaining length, up to 4 bytes, 7 bits each, lsb first
+        j = i + 1
+        rl = 0
+        shift = 0
+        done = False
+        while j < n and j < i + 5:
+            b = mv[j]
+            rl |= (b & 0x7f) << shift
+            j += 1
+            if not b & 0x80:
+                done = True
+                break
+            shift += 7
+        if not done:
+            if j < i + 5:
+                break # remaining length is truncated, we need more bytes
+            i += 1    # invalid remaining length, not a header
+            continue
+        if j + rl > n:
+            break     # we need more bytes
+        splits[o]   = i
+        splits[o+1] = j + rl
+        o   += 2
+        cnt += 1
+        i = j + rl
+    splits[0] = cnt
+    return i
+
+#list version of scan_pkts, returns ([(start,end),...], residue offset)
+def split_bytes_to_pkts(mv):
+    splits = new_splits(max(len(mv)//2, 1))
+    i = scan_pkts(mv, len(mv), splits)
+    pkt_splits = [(splits[1+2*k], splits[2+2*k]) for k in range(splits[0])]
     return (pkt_splits, i,)
 
 
@@ -143,6 +181,92 @@ def encode_remaining_length(num_bytes):
         buff[idx] |= 0x80 #set continuation bit
     return buff[:idx+1]
 
+# mqtt 5 variable byte integer at mv[i], returns (value, offset after it)
+def decode_varint(mv, i):
+    value = 0
+    shift = 0
+    while True:
+        b = mv[i]
+        i += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return (value, i)
+        shift += 7
+        if shift > 21:
+            raise Exception('bad variable byte integer')
+
+def _encode_str(v):
+    if isinstance(v, str):
+        v = bytes(v, 'utf8')
+    return len(v).to_bytes(2,'big') + v
+
+# mqtt 5 properties, [(id, value)] -> their length then the properties.
+# ints, bytes/str for strings and binary, (key, value) for user properties
+def encode_properties(props = None):
+    r = bytearray()
+    if props:
+        types = mqtt_defs.PROP_TYPES
+        for (pid, v) in props:
+            t = types[pid]
+            r += bytes([pid])
+            if t == mqtt_defs.PROP_TYPE_BYTE:
+                r += bytes([v])
+            elif t == mqtt_defs.PROP_TYPE_U16:
+                r += v.to_bytes(2,'big')
+            elif t == mqtt_defs.PROP_TYPE_U32:
+                r += v.to_bytes(4,'big')
+            elif t == mqtt_defs.PROP_TYPE_VARINT:
+                r += encode_remaining_length(v)
+            elif t == mqtt_defs.PROP_TYPE_PAIR:
+                r += _encode_str(v[0]) + _encode_str(v[1])
+            else: # string, binary
+                r += _encode_str(v)
+    return bytes(encode_remaining_length(len(r))) + r
+
+# mqtt 5 properties at mv[i], returns (dict of id -> value, offset after
+# them).  Strings and binary are memoryviews into mv, user properties a
+# list of (key, value).  The dict is None when there are no properties,
+# the usual publish, so there's nothing allocated for it.
+def decode_properties(mv, i):
+    (n, i) = decode_varint(mv, i)
+    end = i + n
+    if not n:
+        return (None, end)
+    types = mqtt_defs.PROP_TYPES
+    props = {}
+    while i < end:
+        pid = mv[i]
+        i += 1
+        t = types.get(pid)
+        if t == mqtt_defs.PROP_TYPE_BYTE:
+            v = mv[i]
+            i += 1
+        elif t == mqtt_defs.PROP_TYPE_U16:
+            v = (mv[i]<<8) | mv[i+1]
+            i += 2
+        elif t == mqtt_defs.PROP_TYPE_U32:
+            v = int.from_bytes(mv[i:i+4], 'big')
+            i += 4
+        elif t == mqtt_defs.PROP_TYPE_VARINT:
+            (v, i) = decode_varint(mv, i)
+        elif t == mqtt_defs.PROP_TYPE_STR or t == mqtt_defs.PROP_TYPE_BIN:
+            l = (mv[i]<<8) | mv[i+1]
+            v = mv[i+2:i+2+l]
+            i += 2+l
+        elif t == mqtt_defs.PROP_TYPE_PAIR:
+            l = (mv[i]<<8) | mv[i+1]
+            k = mv[i+2:i+2+l]
+            i += 2+l
+            l = (mv[i]<<8) | mv[i+1]
+            v = (k, mv[i+2:i+2+l])
+            i += 2+l
+            props.setdefault(pid, []).append(v)
+            continue
+        else:
+            raise Exception('bad mqtt property '+hex(pid))
+        props[pid] = v
+    return (props, end)
+
 # @micropython.native
 def gen_packet_id():
     if IS_UPY:
@@ -175,30 +299,44 @@ def encode_connect(client_id,        # unique Client identifier for the Client (
                    password      = None,
                    will_topic    = None,
                    will_msg      = None,
+                   protocol_level = mqtt_defs.PROTOCOL_LEVEL,
+                   properties    = None, # mqtt 5, [(id, value)] see encode_properties
                    ):
-    varlen = 2 + len(client_id)
+    v5 = protocol_level == mqtt_defs.PROTOCOL_LEVEL_5
+    props = encode_properties(properties) if v5 else b''
+    will = will_topic and will_msg
+    will_props = b'\x00' if v5 and will else b'' # no will properties
+
+    varlen = 10 + len(props) + len(will_props) + 2 + len(client_id)
     for payload in [will_topic, will_msg, username, password]:
         if payload:
             varlen = varlen + 2 + len(payload)
 
-    lc = 12
-    r = bytearray(lc + varlen)
+    remaining_length_bytes = encode_remaining_length(varlen)
+    r = bytearray(1 + len(remaining_length_bytes) + varlen)
     r[0] = mqtt_defs.CONNECT
-    r[1] = len(r) - 2 #remaining length
-    r[2:2+6] = mqtt_defs.CONNECT_HEADER
-    r[8] = mqtt_defs.PROTOCOL_LEVEL
+    lc = 1
+    r[lc:lc+len(remaining_length_bytes)] = remaining_length_bytes #remaining length
+    lc += len(remaining_length_bytes)
+    r[lc:lc+6] = mqtt_defs.CONNECT_HEADER
+    r[lc+6] = protocol_level
 
     #connection flag
+    flags = lc+7
     if username:
-        r[9] |= 0x80 #username
-        r[9] |= 0x40 #password
-    if will_topic and will_msg:
-        r[9] |= 0x04
+        r[flags] |= 0x80 #username
+        r[flags] |= 0x40 #password
+    if will:
+        r[flags] |= 0x04
     if clean_session:
-        r[9] |= 0x02
+        r[flags] |= 0x02
 
     # r += struct.pack('>H', keep_alive) # keep alive
-    r[10:10+2] = struct.pack('>H', keep_alive)
+    r[lc+8:lc+8+2] = struct.pack('>H', keep_alive)
+    lc += 10
+
+    r[lc:lc+len(props)] = props
+    lc += len(props)
 
     #client_id
     #client_id can only use "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
@@ -212,6 +350,9 @@ def encode_connect(client_id,        # unique Client identifier for the Client (
     r[lc:lc+len(client_id)] = bytes(client_id, 'utf8')
     lc += len(client_id)
 
+    r[lc:lc+len(will_props)] = will_props
+    lc += len(will_props)
+
     #payload items, item presence is dependent on connection flags
     for payload in [will_topic, will_msg, username, password]:
         if payload:
@@ -244,12 +385,20 @@ def encode_publish(topic,     #bytes/str/bytearray,
                    qos       = 0,        # qos
                    retain    = True,     # message retained for future subscribers
                    packet_id = None,     # only valid for qos 1 and 2, if None, generate one
+                   v5        = False,    # mqtt 5, properties after the packet_id
+                   topic_alias = 0,      # mqtt 5 topic alias, 0 for none
                     ):
     #single memory allocation version (faster)
     #if qos!=0, then we have the packet_id between topic name and message
     packet_id_len = 2 if qos == mqtt_defs.QOS_1 or qos == mqtt_defs.QOS_2 else 0
+    if not v5:
+        props = b''
+    elif topic_alias:
+        props = bytes([3, mqtt_defs.PROP_TOPIC_ALIAS, topic_alias>>8, topic_alias&0xff])
+    else:
+        props = b'\x00'
 
-    varlen = 2 + len(topic) + packet_id_len + len(payload)
+    varlen = 2 + len(topic) + packet_id_len + len(props) + len(payload)
     remaining_length_bytes = encode_remaining_length(varlen)
     r = bytearray(1 + len(remaining_length_bytes) + varlen)
 
@@ -284,6 +433,9 @@ def encode_publish(topic,     #bytes/str/bytearray,
         r[offset:offset+2] = (packet_id).to_bytes(2,'big')
         offset += 2
 
+    r[offset:offset+len(props)] = props
+    offset += len(props)
+
     #payload
     if isinstance(payload, str):
         r[offset:] = bytes(payload, 'utf8')
@@ -316,6 +468,8 @@ def encode_publish(topic,     #bytes/str/bytearray,
 # @micropython.native
 def encode_subscribe(topic_qoss,       # list of tuple (topic str, qos)
                      packet_id = None, # required, SUBACK will response with packet_id_
+                     v5        = False, # mqtt 5, no properties
+                     no_local  = False, # mqtt 5, don't receive our own publishes
                      ):
     r = bytearray()
     header = mqtt_defs.SUBSCRIBE
@@ -326,6 +480,8 @@ def encode_subscribe(topic_qoss,       # list of tuple (topic str, qos)
         packet_id = gen_packet_id()
     #r += struct.pack('>H', packet_id)
     r += (packet_id).to_bytes(2,'big')
+    if v5:
+        r += b'\x00' #properties
 
     for topic_qos in topic_qoss:
         topic = topic_qos[0]
@@ -337,6 +493,8 @@ def encode_subscribe(topic_qoss,       # list of tuple (topic str, qos)
         else: #if isinstance(topic, (bytes, bytearray, memoryview))::
             r += topic
         #r += struct.pack('>B', qos) # qos
+        if v5 and no_local:
+            qos |= 0x04 # subscription options, no local bit
         r += (qos).to_bytes(1,'big')
 
     #      fixed header    + remaining length                + payload
@@ -361,6 +519,7 @@ def encode_subscribe(topic_qoss,       # list of tuple (topic str, qos)
 # @micropython.native
 def encode_unsubscribe(topics,           # list of topics
                        packet_id = None, # required, SUBACK will response with packet_id_
+                       v5        = False, # mqtt 5, no properties
                        ):
     r = bytearray()
     header = mqtt_defs.UNSUBSCRIBE
@@ -371,6 +530,8 @@ def encode_unsubscribe(topics,           # list of topics
         packet_id = gen_packet_id()
     #r += struct.pack('>H', packet_id)
     r += (packet_id).to_bytes(2,'big')
+    if v5:
+        r += b'\x00' #properties
 
     for topic in topics:
         #r += struct.pack('>H', len(topic)) #length of this payload item
@@ -400,11 +561,20 @@ def encode_disconnect():
 
 
 # @micropython.native
-def decode_connack(pktmv):
-    (session_present, return_code,) = struct.unpack('>BB', pktmv[2:])
+def decode_connack(pktmv, v5=False):
+    if not v5:
+        (session_present, return_code,) = struct.unpack('>BB', pktmv[2:])
+        properties = None
+    else:
+        #mqtt 5, reason code then properties, remaining length may be >1 byte
+        (remaining_length, k) = decode_remaining_length(pktmv[1:5])
+        session_present = pktmv[1+k]
+        return_code     = pktmv[2+k]
+        (properties, _end) = decode_properties(pktmv, 3+k)
     return mqtt_defs.ConnAck_struct(
         session_present = session_present,
         return_code     = return_code,
+        properties      = properties,
     )
 
 
@@ -421,8 +591,11 @@ def decode_connack(pktmv):
 #a=bytes([0x30,0x26,0x0,0x8,0x74,0x69,0x6d,0x65,0x2f,0x72,0x74,0x63,0x28,0x32,0x30,0x32,0x31,0x2c,0x30,0x35,0x2c,0x31,0x30,0x2c,0x31,0x37,0x2c,0x33,0x36,0x2c,0x32,0x31,0x2c,0x39,0x39,0x39,0x39,0x31,0x34,0x29])
 #decode_publish(memoryview(a))
 #decode_remaining_length(memoryview(a))
+# zerocopy, topic and payload are memoryviews into mv instead of bytes copies.
+# They are only valid until the buffer behind mv is reused.
 # @micropython.native
-def decode_publish(mv):
+# v5, properties follow the packet_id, only the topic alias is kept
+def decode_publish(mv, zerocopy=False, v5=False):
     control = mv[0]
     (remaining_length, k) = decode_remaining_length(mv[1:5])
     # print('remaining_length', remaining_length, 'k', k)
@@ -441,30 +614,52 @@ def decode_publish(mv):
         (packet_id,) = struct.unpack('>H', mv[topic_offset+topic_len:topic_offset+topic_len+2])
         payload_offset = topic_offset+topic_len+2
 
+    topic_alias = 0
+    if v5:
+        if mv[payload_offset] == 0: #no properties, the usual case
+            payload_offset += 1
+        else:
+            (props, payload_offset) = decode_properties(mv, payload_offset)
+            topic_alias = props.get(mqtt_defs.PROP_TOPIC_ALIAS, 0)
+
     #print('payload_offset ' +str(payload_offset))
     payload = mv[payload_offset:remaining_length+1+k]
     #print('payload ' +str(bytes(payload)))
+    if not zerocopy:
+        topic   = bytes(topic)#.decode(), #topic must be utf8
+        payload = bytes(payload)
     return mqtt_defs.Publish_struct(
         packet_id = packet_id,
         qos       = qos,
-        topic     = bytes(topic),#.decode(), #topic must be utf8
-        payload   = bytes(payload),
+        topic     = topic,
+        payload   = payload,
+        topic_alias = topic_alias,
+        topic_id  = -1,
     )
 
 # @micropython.native
 def decode_puback(pktmv):
     #QOS 1 only
-    (packet_id,) = struct.unpack('>H', pktmv[2:])
+    (remaining_length, k) = decode_remaining_length(pktmv[1:5])
+    (packet_id,) = struct.unpack('>H', pktmv[1+k:3+k])
+    #mqtt 5 reason code, left out for success
+    reason_code = pktmv[3+k] if remaining_length > 2 else mqtt_defs.REASON_SUCCESS
     return mqtt_defs.PubAck_struct(
         packet_id     = packet_id,
+        reason_code   = reason_code,
     )
 
 # @micropython.native
-def decode_suback(pktmv):
+def decode_suback(pktmv, v5=False):
     #always returned on sub
-    (packet_id,) = struct.unpack('>H', pktmv[2:4])
-    sub_return_codes = [x for x in pktmv[4:]]
-    all_passed = _.all(sub_return_codes, lambda code: code != 0x80)
+    (remaining_length, k) = decode_remaining_length(pktmv[1:5])
+    (packet_id,) = struct.unpack('>H', pktmv[1+k:3+k])
+    i = 3+k
+    if v5:
+        (_props, i) = decode_properties(pktmv, i)
+    sub_return_codes = [x for x in pktmv[i:]]
+    #3.1.1 has 0x80 for failure, mqtt 5 reason codes >= 0x80
+    all_passed = _.all(sub_return_codes, lambda code: code < 0x80)
     return mqtt_defs.SubAck_struct(
         packet_id        = packet_id,
         sub_return_codes = sub_return_codes,
@@ -473,7 +668,9 @@ def decode_suback(pktmv):
 
 # @micropython.native
 def decode_unsuback(pktmv):
-    (packet_id,) = struct.unpack('>H', pktmv[2:])
+    #mqtt 5 properties and reason codes follow, not used
+    (remaining_length, k) = decode_remaining_length(pktmv[1:5])
+    (packet_id,) = struct.unpack('>H', pktmv[1+k:3+k])
     return mqtt_defs.UnsubAck_struct(
         packet_id     = packet_id,
     )
@@ -482,9 +679,23 @@ def decode_unsuback(pktmv):
 def decode_pingresp(pktmv):
     return None
 
+# mqtt 5, the server closing the connection says why
+# @micropython.native
+def decode_disconnect(pktmv):
+    (remaining_length, k) = decode_remaining_length(pktmv[1:5])
+    reason_code = pktmv[1+k] if remaining_length else mqtt_defs.REASON_SUCCESS
+    properties = None
+    if remaining_length > 1:
+        (properties, _end) = decode_properties(pktmv, 2+k)
+    return mqtt_defs.Disconnect_struct(
+        reason_code = reason_code,
+        properties  = properties,
+    )
+
 
+# zerocopy, see decode_publish.  v5, the connection is mqtt 5.
 # @micropython.native
-def decode(pkt):
+def decode(pkt, zerocopy=False, v5=False):
     mv = memoryview(pkt)
 
     # print(binascii.hexlify(mv[0:20],','))
@@ -496,17 +707,19 @@ def decode(pkt):
    
     obj = None
     if mqtt_type == mqtt_defs.CONNACK:
-        obj = decode_connack(mv)
+        obj = decode_connack(mv, v5)
     elif mqtt_type == mqtt_defs.PUBACK:
         obj = decode_puback(mv)
     elif mqtt_type == mqtt_defs.SUBACK:
-        obj = decode_suback(mv)
+        obj = decode_suback(mv, v5)
     elif mqtt_type == mqtt_defs.UNSUBACK:
         obj = decode_unsuback(mv)
     elif mqtt_type == mqtt_defs.PINGRESP:
         obj = decode_pingresp(mv)
     elif mqtt_type == mqtt_defs.PUBLISH:
-        obj = decode_publish(mv)
+        obj = decode_publish(mv, zerocopy, v5)
+    elif mqtt_type == mqtt_defs.DISCONNECT:
+        obj = decode_disconnect(mv)
     else:
         raise Exception('no mqtt decoder for '+str(bytes(mqtt_type)))
     
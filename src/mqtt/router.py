@@ -0,0 +1,135 @@
+import micropython
+from micropython import const
+
+from .topics import TopicTable
+
+_SLASH  = const(0x2f) # b'/'
+_DOLLAR = const(0x24) # b'$'
+
+# level == mv[start:start+len(level)], compared in place, a slice of mv
+# would allocate a memoryview per literal compared
+@micropython.native
+def _level_eq(level, mv, start):
+    for i in range(len(level)):
+        if level[i] != mv[start+i]:
+            return False
+    return True
+
+class _Node:
+    def __init__(self):
+        self.children = [] # [(level, _Node)], literal levels
+        self.plus = None   # _Node of a + level
+        self.hash = []     # handlers of a # level here
+        self.handlers = [] # handlers of filters ending here
+
+# Dispatch of received publishes to handlers by topic filter.
+#   router = MQTTRouter()
+#   router.add(b'ki5tof/ota/+', on_ota)
+#   matched = await router.dispatch(msg)
+# Filters are compiled into a trie of topic levels.  + matches one level,
+# # the rest of the topic and its parent (b'a/#' matches b'a').  Topics
+# starting with $ don't match a leading wildcard.  Topics are walked in
+# place by offset, no split, slice or copy of a zerocopy topic.  A node
+# has few literal levels, they're compared in turn, length first, then
+# byte by byte against the topic.
+# Topics are interned (see TopicTable) and the matches of an interned topic
+# are kept by its id, a repeated topic is dispatched without a walk.
+# Handlers are async fn(msg, rest), rest is the topic from the first level
+# a wildcard matched, empty for a filter without one.  For b'ki5tof/ota/+'
+# and b'ki5tof/ota/chunk' it's b'chunk'.  bytes kept with the matches for
+# an interned topic, a memoryview of the topic otherwise.
+class MQTTRouter:
+    def __init__(self, topics = None):
+        self.root = _Node()
+        self.topics = topics if topics is not None else TopicTable()
+        self.routes = {} # topic id -> (topic, ((handler, rest), ...))
+
+    # handler for topic_filter (bytes)
+    def add(self, topic_filter, handler):
+        node = self.root
+        levels = topic_filter.split(b'/')
+        for (i, level) in enumerate(levels):
+            if level == b'#':
+                if i != len(levels)-1:
+                    raise ValueError('# must be the last level {}'.format(topic_filter))
+                node.hash.append(handler)
+                break
+            if level == b'+':
+                if node.plus is None:
+                    node.plus = _Node()
+                node = node.plus
+                continue
+            for (child_level, child) in node.children:
+                if child_level == level:
+                    node = child
+                    break
+            else:
+                child = _Node()
+                node.children.append((level, child))
+                node = child
+        else:
+            node.handlers.append(handler)
+        self.routes.clear() # cached matches may miss the new filter
+
+    # collects (handler, rest offset) of the filters matching the topic
+    def match(self, mv, out):
+        n = len(mv)
+        dollar = n and mv[0] == _DOLLAR
+        self.walk(self.root, mv, n, 0, -1, dollar, out)
+        return out
+
+    # node matched the topic up to offset start, wild is the offset of the
+    # first wildcard level or -1
+    def walk(self, node, mv, n, start, wild, dollar, out):
+        while True:
+            if node.hash and not (dollar and start == 0):
+                rest = min(start, n) if wild < 0 else wild
+                for handler in node.hash:
+                    out.append((handler, rest))
+            if start > n: # past the last level
+                rest = n if wild < 0 else wild
+                for handler in node.handlers:
+                    out.append((handler, rest))
+                return
+            end = start
+            while end < n and mv[end] != _SLASH:
+                end += 1
+            if node.plus is not None and not (dollar and start == 0):
+                self.walk(node.plus, mv, n, end+1, start if wild < 0 else wild, dollar, out)
+            seg_len = end-start
+            for (level, child) in node.children:
+                if len(level) == seg_len and _level_eq(level, mv, start):
+                    node = child
+                    break
+            else:
+                return
+            start = end+1
+
+    # the matches of an interned topic, once.  Again if the id was reused
+    # for another topic (TopicTable, aliased topics).
+    def route(self, tid, mv):
+        topic = self.topics.topic(tid)
+        entry = self.routes.get(tid)
+        if entry is None or entry[0] is not topic:
+            entry = (topic, tuple((handler, topic[rest:]) for (handler, rest) in self.match(mv, [])))
+            self.routes[tid] = entry
+        return entry[1]
+
+    # call the handlers of msg.topic, tid is its topic id if the caller
+    # interned it already, msg.topic_id is if MQTTCore did (topic alias).
+    # Returns the number called.
+    async def dispatch(self, msg, tid = None):
+        mv = memoryview(msg.topic)
+        if tid is None and msg.topic_id >= 0 and msg.topic is self.topics.topic(msg.topic_id):
+            tid = msg.topic_id # not reused since
+        if tid is None:
+            tid = self.topics.intern(mv)
+        if tid < 0: # table full
+            matched = self.match(mv, [])
+            for (handler, rest) in matched:
+                await handler(msg, mv[rest:])
+            return len(matched)
+        routes = self.route(tid, mv)
+        for (handler, rest) in routes:
+            await handler(msg, rest)
+        return len(routes)
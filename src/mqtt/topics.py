@@ -0,0 +1,98 @@
+import micropython
+from micropython import const
+
+_TOPICS_MAX = const(32) # interned topics, past it topics aren't interned
+
+# hash of a topic, kept to 20 bits so it stays a small int
+@micropython.native
+def topic_hash(mv):
+    h = 0
+    for b in mv:
+        h = ((h << 5) ^ (h >> 15) ^ b) & 0xfffff
+    return h
+
+# Interned topics, a topic seen before is found by hash and compare (no
+# allocation) and is known by a small int id from then on.  A new topic is
+# copied once.  Also the mqtt 5 topic alias map of a connection, alias ->
+# topic id, so an aliased publish resolves to the same id.  An aliased
+# topic gets an id past max_topics too, those ids are reused once no alias
+# maps to them, the table holds at most max_topics plus one topic per
+# alias.  A reused id has a new topic bytes object, holders of an id check
+# it against topic(tid) (see MQTTRouter).
+class TopicTable:
+    def __init__(self, max_topics = _TOPICS_MAX):
+        self.max_topics = max_topics
+        self.topics = [] # id -> topic bytes
+        self.ids = {}    # hash -> [id]
+        self.aliases = {} # alias -> id
+        self.free = []   # ids past max_topics no alias maps to
+
+    # id of topic (bytes or memoryview), -1 if it isn't interned
+    def find(self, topic):
+        ids = self.ids.get(topic_hash(topic))
+        if ids:
+            n = len(topic)
+            for tid in ids:
+                t = self.topics[tid]
+                if len(t) == n and t == topic:
+                    return tid
+        return -1
+
+    # id of topic, -1 if it's new and the table is full
+    def intern(self, topic):
+        tid = self.find(topic)
+        if tid < 0 and len(self.topics) < self.max_topics:
+            tid = self.add(topic)
+        return tid
+
+    # new id for topic, a free one if there is one
+    def add(self, topic):
+        topic = bytes(topic)
+        if self.free:
+            tid = self.free.pop()
+            h = topic_hash(self.topics[tid])
+            self.ids[h].remove(tid)
+            if not self.ids[h]:
+                del self.ids[h]
+            self.topics[tid] = topic
+        else:
+            tid = len(self.topics)
+            self.topics.append(topic)
+        h = topic_hash(topic)
+        ids = self.ids.get(h)
+        if ids:
+            ids.append(tid)
+        else:
+            self.ids[h] = [tid]
+        return tid
+
+    def topic(self, tid):
+        return self.topics[tid]
+
+    # a publish carried an alias and its topic, returns the topic's id
+    def set_alias(self, alias, topic):
+        tid = self.find(topic)
+        if tid < 0 or tid != self.aliases.get(alias, -1):
+            self.drop_alias(alias)
+            if tid < 0:
+                tid = self.intern(topic)
+                if tid < 0:
+                    tid = self.add(topic) # past max_topics
+            self.aliases[alias] = tid
+        return tid
+
+    # the alias no longer maps to its id, free the id if it's past
+    # max_topics and no other alias maps to it
+    def drop_alias(self, alias):
+        tid = self.aliases.pop(alias, -1)
+        if tid >= self.max_topics and tid not in self.aliases.values():
+            self.free.append(tid)
+
+    # topic id of an alias, -1 if unknown
+    def alias(self, alias):
+        return self.aliases.get(alias, -1)
+
+    # aliases only last a connection
+    def clear_aliases(self):
+        self.aliases.clear()
+        self.free = list(range(self.max_topics, len(self.topics)))
@@ -1,6 +1,7 @@
 # NeoPixel driver for MicroPython
 # MIT license; Copyright (c) 2016 Damien P. George, 2021 Jim Mussared
 
+import micropython
 from machine import bitstream
 
 
@@ -13,6 +14,9 @@ class NeoPixel:
         self.n = n
         self.bpp = bpp
         self.buf = bytearray(n * bpp)
+        self._order = bytes(self.ORDER[:bpp])
+        self._on = bytearray(bpp)
+        self._off = bytearray(bpp)
         self.pin.init(pin.OUT)
         # Timing arg can either be 1 for 800kHz or 0 for 400kHz,
         # or a user-specified timing ns tuple (high_0, low_0, high_1, low_1).
@@ -45,7 +49,60 @@ class NeoPixel:
                 b[j] = c
                 j += bpp
 
+    # Bulk set from a 1bpp framebuf.MONO_VLSB mask, pixels laid out in rows of
+    # width.  Set pixels are on_rgb, clear are off_rgb.  Colours are applied
+    # in ORDER once rather than per pixel.
+    def blit_mask(self, mask, on_rgb, off_rgb, width):
+        on = self._on
+        off = self._off
+        for i in range(self.bpp):
+            on[self.ORDER[i]] = on_rgb[i]
+            off[self.ORDER[i]] = off_rgb[i]
+        _blit_mask(self.buf, mask, on, off, self.n, self.bpp, width)
+
+    # Bulk set from a buffer of bpp bytes per pixel in RGB(W) order.
+    def blit_rgb(self, buf):
+        _blit_rgb(self.buf, buf, self.n, self.bpp, self._order)
+
     def write(self):
         # BITSTREAM_TYPE_HIGH_LOW = 0
         bitstream(self.pin, 0, self.timing, self.buf)
 
+
+
+@micropython.viper
+def _blit_mask(buf: ptr8, mask: ptr8, on: ptr8, off: ptr8, n: int, bpp: int, width: int):
+    i: int = 0
+    j: int = 0
+    o: int = 0
+    x: int = 0
+    y: int = 0
+    while i < n:
+        j = 0
+        if (mask[(y >> 3) * width + x] >> (y & 7)) & 1:
+            while j < bpp:
+                buf[o + j] = on[j]
+                j += 1
+        else:
+            while j < bpp:
+                buf[o + j] = off[j]
+                j += 1
+        o += bpp
+        i += 1
+        x += 1
+        if x == width:
+            x = 0
+            y += 1
+
+
+@micropython.viper
+def _blit_rgb(buf: ptr8, src: ptr8, n: int, bpp: int, order: ptr8):
+    j: int = 0
+    o: int = 0
+    end: int = n * bpp
+    while o < end:
+        j = 0
+        while j < bpp:
+            buf[o + order[j]] = src[o + j]
+            j += 1
+        o += bpp
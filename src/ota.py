@@ -0,0 +1,311 @@
+
+import sys
+import io
+import time
+import asyncio
+import hashlib
+import deflate
+import esp32
+import ccrc
+from micropython import const
+
+OTA_BLOCK_SIZE = const(4096)     # flash erase block, one ota page
+_OTA_WRITE_CHUNK = const(1024)   # flash written per yield to the event loop
+_OTA_STATS_PAGES = const(64)     # print stats every n pages
+_OTA_CARRY_MAX = const(16)       # unread bytes kept between chunks
+
+_IOCTL_BLOCK_COUNT = const(4)
+_IOCTL_BLOCK_ERASE = const(6)
+
+# Stream over the current message payload, one instance reused for every
+# chunk.  Subclass of io.IOBase so the native DeflateIO can read from it,
+# readinto copies straight from the payload's memoryview (io.BytesIO would
+# copy the whole payload first, it only references bytes/str).
+# The image is one deflate stream across chunks, the few bytes of a chunk
+# the decompressor hasn't read yet (the end of the sync flush) are kept
+# and served ahead of the next payload.
+class PayloadReader(io.IOBase):
+    def __init__(self):
+        self.mv = memoryview(b'')
+        self.idx = 0
+        self.carry = bytearray(_OTA_CARRY_MAX)
+        self.carry_len = 0
+        self.carry_idx = 0
+        self.carry_hw = 0 # high water mark of carry_len, for stats
+
+    def set(self, payload):
+        self.mv = memoryview(payload)
+        self.idx = 0
+
+    # keep the unread rest of the payload, the mqtt rx buffer it's in is
+    # reused after the message
+    def keep(self):
+        n = len(self.mv)-self.idx
+        if n > _OTA_CARRY_MAX:
+            raise ValueError('ota chunk has {} bytes past its pages'.format(n))
+        self.carry[:n] = self.mv[self.idx:]
+        self.carry_len = n
+        if n > self.carry_hw:
+            self.carry_hw = n
+        self.carry_idx = 0
+        self.set(b'')
+
+    def clear(self):
+        self.carry_len = 0
+        self.carry_idx = 0
+        self.set(b'')
+
+    def readinto(self, buf):
+        if self.carry_idx < self.carry_len:
+            n = min(len(buf), self.carry_len-self.carry_idx)
+            buf[:n] = self.carry[self.carry_idx:self.carry_idx+n]
+            self.carry_idx += n
+            return n
+        n = min(len(buf), len(self.mv)-self.idx)
+        buf[:n] = self.mv[self.idx:self.idx+n]
+        self.idx += n
+        return n
+
+# Writes the ota image received over mqtt to the next update partition.
+# Protocol, topics under <root>/ota/, see tools/pushfw.py
+#   start    payload is the image size in pages, starts a new transfer
+#   manifest payload is a number of pages, replies on <root>/ota/crcs with
+#            the crcs of those pages of the running image, for delta updates
+#   chunk    whole pages, payload is the start page (2 bytes, big endian),
+#            the page count (1 byte) then the next piece of the image's
+#            deflate stream, sync flushed at the end of the chunk
+#   copy     pages unchanged from the running image, payload is the start
+#            page (2 bytes, big endian) and the page count (1 byte)
+#   done     payload is the sha256 of the image (whole pages, 0xff padded),
+#            boot the new image if every page arrived and it matches
+# The topics are fixed so they repeat, the router interns them and an mqtt 5
+# broker can alias them.
+# start, chunks, copies and done are acked on <root>/ota/ack with b'start',
+# the start page (ascii), c<start page> or b'done' so the sender can
+# keep a window of them in flight.
+# Pages are taken strictly in order, the sha256 is accumulated from the page
+# buffer as each page is written, no read back of the image.  A chunk or
+# copy past the next expected page is dropped and nacked on <root>/ota/nack
+# with the expected page, the sender goes back to it (go-back-n).  A done
+# with pages missing is nacked the same way, a bad digest restarts the
+# transfer with a nack of page 0.
+# manifest crcs are 4 bytes per page, ccrc.crc16 then ccrc.crc16_ccit, big
+# endian.
+#   inflates each page into one reusable page buffer
+#   tracks the written pages, duplicates (re-sent chunks) are dropped
+#   erases and writes flash in _OTA_WRITE_CHUNK pieces, yielding between
+#   them so the display keeps running
+# The changed pages of the image are one zlib stream (a solid stream),
+# back references cross chunks and one DeflateIO with its window is made
+# per transfer, not per chunk.  Pages are taken in order so the
+# decompressor is always at the start of the chunk for next_page, a go-back
+# re-sends the same piece of the stream.  A reset drops the DeflateIO, the
+# sender starts the stream over from page 0.  The window is sized from the
+# zlib header, pushfw.py compresses with a 4KB window (wbits=12) to keep it
+# small.  DeflateIO can't pause mid symbol at the end of a payload, the
+# sync flush and the page count in the chunk make sure it never reads past
+# the pages it was sent.
+class OTAWriter:
+    def __init__(self, part = None):
+        self.running = esp32.Partition(esp32.Partition.RUNNING)
+        if part is None:
+            part = self.running.get_next_update()
+        self.part = part
+        self.num_pages = part.ioctl(_IOCTL_BLOCK_COUNT, 0)
+
+        self.buf = bytearray(OTA_BLOCK_SIZE)
+        self.mv = memoryview(self.buf)
+        self.reader = PayloadReader()
+        self.d = None # DeflateIO, the image's stream
+        self.pages = bytearray((self.num_pages+7)//8) # written pages bitmap
+        self.reset()
+
+    # start over, a new transfer
+    def reset(self, image_pages = 0):
+        if image_pages > self.num_pages:
+            raise ValueError('ota image of {} pages, partition has {}'.format(image_pages, self.num_pages))
+        self.pages[:] = bytes(len(self.pages))
+        self.d = None
+        self.reader.clear()
+        self.next_page = 0
+        self.image_pages = image_pages
+        self.sha = hashlib.sha256()
+        self.digest = None
+        self.verified = False
+
+        #stats
+        self.ticks_start = None
+        self.written = 0
+        self.copied = 0
+        self.dupes = 0
+        self.out_of_order = 0 # nacked
+        self.bytes_in = 0 # compressed
+
+    def has_page(self, page):
+        return self.pages[page>>3] & (1<<(page&7))
+
+    def set_page(self, page):
+        self.pages[page>>3] |= 1<<(page&7)
+
+    # the page buffer holds page as written to flash
+    def commit(self, page):
+        self.sha.update(self.buf)
+        self.set_page(page)
+
+    # next page can't be taken, returns the nack reply
+    def nack(self):
+        self.out_of_order += 1
+        return (b'nack', str(self.next_page).encode())
+
+    # inflate the next page of the stream into the page buffer
+    def inflate(self):
+        d = self.d
+        mv = self.mv
+        n = 0
+        while n < OTA_BLOCK_SIZE:
+            r = d.readinto(mv[n:])
+            if not r:
+                raise ValueError('ota chunk short, {} bytes of a page'.format(n))
+            n += r
+
+    # erase and write the page buffer to flash, yielding between chunks
+    async def write(self, page):
+        part = self.part
+        mv = self.mv
+        sleep_ms = asyncio.sleep_ms
+        part.ioctl(_IOCTL_BLOCK_ERASE, page)
+        await sleep_ms(0)
+        for offset in range(0, OTA_BLOCK_SIZE, _OTA_WRITE_CHUNK):
+            part.writeblocks(page, mv[offset:offset+_OTA_WRITE_CHUNK], offset)
+            await sleep_ms(0)
+
+    # write a chunk of pages from start, returns pages written
+    async def write_chunk(self, start, payload):
+        if self.ticks_start is None:
+            self.ticks_start = time.ticks_ms()
+        count = payload[2]
+        if start+count > self.num_pages:
+            raise ValueError('ota chunk {}+{} out of range'.format(start, count))
+        self.reader.set(memoryview(payload)[3:])
+        if self.d is None:
+            self.d = deflate.DeflateIO(self.reader, deflate.ZLIB)
+        for page in range(start, start+count):
+            self.inflate()
+            await self.write(page)
+            self.commit(page)
+            self.written += 1
+            if self.written % _OTA_STATS_PAGES == 0:
+                self.print_stats()
+        self.reader.keep()
+        self.next_page = start+count
+        self.bytes_in += len(payload)
+        return count
+
+    # copy count pages from the running image, returns pages copied
+    async def copy(self, start, count):
+        if start+count > self.num_pages:
+            raise ValueError('ota copy {}+{} out of range'.format(start, count))
+        buf = self.buf
+        for page in range(start, start+count):
+            # the update partition often holds the page already (a/b
+            # partitions converge), reads are cheap next to erase+write.
+            # The buffer ends up holding the page as it is in flash, what
+            # commit() hashes, so a crc collision that skips a write fails
+            # the digest instead of passing it.
+            self.running.readblocks(page, buf)
+            crcs = (ccrc.crc16(buf), ccrc.crc16_ccit(buf))
+            self.part.readblocks(page, buf)
+            if crcs != (ccrc.crc16(buf), ccrc.crc16_ccit(buf)):
+                self.running.readblocks(page, buf)
+                await self.write(page)
+            else:
+                await asyncio.sleep_ms(0)
+            self.commit(page)
+            self.copied += 1
+        self.next_page = start+count
+        return count
+
+    # check every page arrived and the digest, returns the reply
+    def verify(self, digest):
+        for page in range(self.image_pages):
+            if not self.has_page(page):
+                return self.nack()
+        if self.digest is None:
+            self.digest = self.sha.digest() # once, the hash is done after
+        if self.digest != bytes(digest):
+            print('OTA digest mismatch, restarting')
+            self.reset(self.image_pages)
+            return self.nack()
+        self.verified = True
+        self.finish()
+        return (b'ack', b'done')
+
+    # crcs of the first pages of the running image
+    async def manifest(self, pages):
+        pages = min(pages, self.num_pages)
+        crcs = bytearray(4*pages)
+        buf = self.buf
+        crc16 = ccrc.crc16
+        crc16_ccit = ccrc.crc16_ccit
+        for page in range(pages):
+            self.running.readblocks(page, buf)
+            crcs[4*page:4*page+2] = crc16(buf).to_bytes(2, 'big')
+            crcs[4*page+2:4*page+4] = crc16_ccit(buf).to_bytes(2, 'big')
+            await asyncio.sleep_ms(0)
+        return crcs
+
+    # handle <root>/ota/<cmd>, returns (topic level, payload) to publish
+    # under <root>/ota/ or None
+    async def on_msg(self, cmd, payload):
+        if cmd == b'start':
+            self.reset(int(bytes(payload).decode()))
+            print('OTA start', self.image_pages, 'pages')
+            return (b'ack', cmd)
+        if cmd == b'manifest':
+            return (b'crcs', await self.manifest(int(bytes(payload).decode())))
+        if cmd == b'done':
+            return self.verify(payload)
+        is_copy = cmd == b'copy'
+        if not is_copy and cmd != b'chunk':
+            print('OTA unknown', cmd)
+            return None
+        page = payload[0]<<8 | payload[1]
+        if page < self.next_page:
+            self.dupes += 1 # re-sent, already have it
+            return (b'ack', self.key(page, is_copy))
+        if page > self.next_page:
+            return self.nack()
+        try:
+            if is_copy:
+                await self.copy(page, payload[2])
+            else:
+                await self.write_chunk(page, payload)
+        except Exception as err:
+            # pages of it may be in the hash, start over
+            sys.print_exception(err)
+            self.reset(self.image_pages)
+            return self.nack()
+        return (b'ack', self.key(page, is_copy))
+
+    # ack payload of a chunk or copy
+    def key(self, page, is_copy):
+        return ('c{}' if is_copy else '{}').format(page).encode()
+
+    def kbps(self):
+        if self.ticks_start is None:
+            return 0
+        ms = time.ticks_diff(time.ticks_ms(), self.ticks_start)
+        return round(self.written*OTA_BLOCK_SIZE/ms, 1) if ms else 0 # B/ms ~ KB/s
+
+    def print_stats(self):
+        print('OTA pages', self.written, '/', self.num_pages,
+              'copied', self.copied,
+              'dupes', self.dupes,
+              'out of order', self.out_of_order,
+              'KB/s', self.kbps(),
+              'ratio', round(self.bytes_in/(self.written*OTA_BLOCK_SIZE), 2) if self.written else 0)
+
+    # boot the new image on next reset
+    def finish(self):
+        self.print_stats()
+        self.part.set_boot()
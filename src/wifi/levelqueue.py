@@ -0,0 +1,190 @@
+
+from micropython import const
+from asyncio import Event
+from collections import deque
+
+_PRIORITY_LEN = const(8)  # control pkts, acks/pings/subscribes
+_NORMAL_LEN = const(64)   # publishes, max_bytes is the usual limit
+_NO_BUDGET = const(0x3fffffff) # max_bytes None, stays a small int
+
+# item_len of a queue without byte counting
+def _no_len(v):
+    return 0
+
+# One level of a LevelQueue, its items and their meta, item bytes<<1 | 1
+# if it can be dropped (put with drop_oldest).  A deque with a maxlen is a
+# preallocated ring in C on micropython, append/popleft don't allocate and
+# popleft lets go of the item.  size is checked before append, a full deque
+# would drop its oldest item on CPython.  peek_len and make_room read the
+# head's meta with meta[0], deque subscripting needs micropython >= 1.23
+# built with MICROPY_PY_COLLECTIONS_DEQUE_SUBSCR.
+class _Ring:
+    def __init__(self, size):
+        self.items = deque((), size)
+        self.meta = deque((), size)
+        self.size = size
+
+# Multi-level queue on the socket/mqtt path, in place of
+# lib.priorityqueue.PriorityQueue whose lists pop(0).
+# A preallocated ring (_Ring) for each of the two levels, priority and
+# normal, priority is served first.  put(is_priority=True) goes to the
+# priority ring, everything else to the normal one.  A queue of one level
+# (sizes=(n,)) has one ring for both.  put/get don't allocate.  The length
+# of an item is taken once on put and kept with it, peek_len and the
+# running nbytes don't call item_len again.  The events are only set when
+# a task waits on them.
+#   sizes     items per level, (priority, normal) or (n,)
+#   item_len  fn(item) -> bytes, None for queues of objects (no byte count)
+#   max_bytes budget of the queued bytes, None for no budget.  The priority
+#             level (control pkts) counts in it but never waits on it, its
+#             ring bounds it.
+# A full level or budget makes put() wait for a get, put_nowait() raises
+# IndexError.  put_nowait(drop_oldest=True) (qos0 publishes) makes room by
+# dropping the oldest items of the level that were put the same way, if
+# the head of the level can't be dropped the new item is dropped instead.
+# An item over the budget is let into a queue holding no bytes, so it can't
+# wait forever.  A got or dropped item isn't referenced from its ring, the
+# budget bounds the bytes the queue keeps alive, not just those counted.
+class LevelQueue:
+    def __init__(self, sizes     = (_PRIORITY_LEN, _NORMAL_LEN),
+                       item_len  = len,
+                       max_bytes = None,
+                       ):
+        if not 0 < len(sizes) <= 2:
+            raise ValueError('one or two levels')
+        self.levels = tuple(_Ring(n) for n in sizes)
+        self.hi = self.levels[0]  # is_priority
+        self.lo = self.levels[-1] # the rest, hi for one level
+        self.item_len = item_len or _no_len
+        self.max_bytes = max_bytes
+        self.budget = _NO_BUDGET if max_bytes is None else max_bytes
+        self.count = 0
+        self.nbytes = 0
+        # tasks in wait() and put(), the events are left alone without them
+        self.evput = Event()
+        self.evget = Event()
+        self.getters = 0
+        self.putters = 0
+
+        #stats
+        self.count_hw = 0  # high water marks, reset_stats() clears
+        self.nbytes_hw = 0
+        self.dropped = 0
+
+    def empty(self):
+        return self.count == 0
+
+    def qsize(self):
+        return self.count
+
+    # room in ring r for an item of n bytes
+    def has_room(self, r, n):
+        if len(r.items) == r.size:
+            return False
+        return r is self.hi or self.nbytes == 0 or self.nbytes+n <= self.budget
+
+    # remove the head of ring r
+    def take(self, r):
+        v = r.items.popleft()
+        self.nbytes -= r.meta.popleft() >> 1
+        self.count -= 1
+        if self.putters:
+            self.evget.set() # wakes the waiting puts
+            self.evget.clear()
+        return v
+
+    # drop the oldest droppable items of ring r until an item of n bytes
+    # fits, stops at an item that can't be dropped
+    def make_room(self, r, n):
+        while not self.has_room(r, n) and r.items and r.meta[0] & 1:
+            self.take(r)
+            self.dropped += 1
+
+    def put_nowait(self, v, is_priority = False, drop_oldest = False):
+        r = self.hi if is_priority else self.lo
+        n = self.item_len(v)
+        nbytes = self.nbytes+n
+        items = r.items
+        if len(items) == r.size or nbytes > self.budget and self.nbytes and r is not self.hi:
+            if drop_oldest:
+                self.make_room(r, n)
+            if not self.has_room(r, n):
+                if drop_oldest:
+                    self.dropped += 1
+                raise IndexError
+            nbytes = self.nbytes+n
+        items.append(v)
+        r.meta.append((n << 1) | 1 if drop_oldest else n << 1)
+        self.nbytes = nbytes
+        self.count += 1
+        if self.count > self.count_hw:
+            self.count_hw = self.count
+        if nbytes > self.nbytes_hw:
+            self.nbytes_hw = nbytes
+        if self.getters:
+            self.evput.set() # wakes the waiting gets
+            self.evput.clear()
+
+    # waits for room in the level and the byte budget
+    async def put(self, v, is_priority = False):
+        r = self.hi if is_priority else self.lo
+        n = self.item_len(v)
+        while not self.has_room(r, n):
+            self.putters += 1
+            try:
+                await self.evget.wait()
+            finally:
+                self.putters -= 1
+        self.put_nowait(v, is_priority)
+
+    def reset_stats(self):
+        self.count_hw = self.count
+        self.nbytes_hw = self.nbytes
+        self.dropped = 0
+
+    # wait for an item without getting it
+    async def wait(self):
+        while self.count == 0:
+            self.getters += 1
+            try:
+                await self.evput.wait()
+            finally:
+                self.getters -= 1
+
+    def peek(self):
+        r = self.hi if self.hi.items else self.lo
+        return r.items[0] # IndexError if empty
+
+    # length of the next item, 0 if empty
+    def peek_len(self):
+        r = self.hi
+        if not r.items:
+            r = self.lo
+            if not r.items:
+                return 0
+        return r.meta[0] >> 1
+
+    # take() inlined, it's the hot path
+    def get_nowait(self):
+        r = self.hi
+        if not r.items:
+            r = self.lo
+            if not r.items:
+                raise IndexError
+        v = r.items.popleft()
+        self.nbytes -= r.meta.popleft() >> 1
+        self.count -= 1
+        if self.putters:
+            self.evget.set()
+            self.evget.clear()
+        return v
+
+    async def get(self):
+        await self.wait()
+        return self.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
@@ -0,0 +1,81 @@
+
+import asyncio
+from micropython import const
+from asyncio import Event
+
+_RX_STREAM_SIZE = const(1024*5)
+_RX_STREAM_MAX  = const(1024*32) # parsers keep 16 bit offsets into the buffer
+
+# Receive buffer shared between the socket reader and the protocol parser.
+# The reader does sock.readinto(window()) straight into the free space at the
+# end and commit()s what it read.  The parser scans mv[:idx] and consume()s
+# whole packets from the front, the residue is moved to the front.  Packets
+# stay contiguous in the buffer for the parser, nothing is copied out of the
+# socket read and there is no queue hop.  The window is a memoryview kept
+# until idx moves, a read that gets data makes one new one in commit(), an
+# empty read or poll makes none.
+class RxStream:
+    def __init__(self, size     = _RX_STREAM_SIZE,
+                       max_size = _RX_STREAM_MAX,
+                       ):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.idx = 0 # end of the data
+        self.win = self.mv # mv[idx:], see set_win()
+        self.idx_hw = 0 # high water mark of idx, for stats
+        self.max_size = max_size
+
+        self.ready = Event() # data was committed
+        self.space = Event() # the window isn't empty
+        self.space.set()
+
+    # free space at the end of the buffer to read into
+    def window(self):
+        return self.win
+
+    # after idx or the buffer changed
+    def set_win(self):
+        self.win = self.mv[self.idx:]
+
+    # n bytes were read into the window
+    def commit(self, n):
+        self.idx += n
+        self.set_win()
+        if self.idx > self.idx_hw:
+            self.idx_hw = self.idx
+        if self.idx >= len(self.buf):
+            self.space.clear()
+        self.ready.set()
+
+    # wait for committed data
+    async def wait(self):
+        await self.ready.wait()
+        self.ready.clear()
+
+    # drop n bytes from the front, the residue moves to the front
+    def consume(self, n):
+        idx = self.idx
+        if n:
+            self.mv[0:idx-n] = self.mv[n:idx]
+            self.idx = idx-n
+            self.set_win()
+        if self.idx >= len(self.buf):
+            # full and no whole packet in it, the packet is bigger than the buffer
+            self.grow()
+        self.space.set()
+
+    def grow(self):
+        size = min(len(self.buf)*2, self.max_size)
+        if size <= len(self.buf):
+            raise Exception('rx stream overflow')
+        buf = bytearray(size)
+        buf[:self.idx] = self.mv[:self.idx]
+        self.buf = buf
+        self.mv = memoryview(buf)
+        self.set_win()
+
+    def clear(self):
+        self.idx = 0
+        self.set_win()
+        self.ready.clear()
+        self.space.set()
@@ -17,15 +17,26 @@ from asyncio import Event
 import binascii
 
 import wifi.defs as wifi_defs
+from wifi.stream import RxStream
+from wifi.levelqueue import LevelQueue
 
 from lib.debug import DebugMixin
-from lib.priorityqueue import PriorityQueue
 from lib import cancel_gather_wait_for_ms
 
 
 _BUSY_ERRORS = [errno.EINPROGRESS, errno.ETIMEDOUT, 118, 119]
 _SOCKET_POLL_DELAY = const(10) #slow poll delay so we don't slam
 
+# socket io modes
+IO_STREAM = const(0) # wake on socket readiness, asyncio stream (select.poll)
+IO_SLEEP  = const(1) # fallback, sleep _SOCKET_POLL_DELAY between reads
+
+# tx coalescing, hold writes up to this long/this many bytes so a burst of
+# packets goes out as one tls record.  flush() sends immediately.
+_TX_COALESCE_MS    = const(5)
+_TX_COALESCE_BYTES = const(1400) # about one tcp segment
+_TX_Q_MAX_BYTES    = const(1024*8) # tx_q byte budget, puts wait or drop qos0 past it
+
 #socket.getaddrinfo is blocking.  Keep global list of results so we don't block
 #more than once
 AddrInfos =[]
@@ -36,8 +47,13 @@ class WifiSocket(DebugMixin):
                        port     = None,
                        en_ssl   = True,
                        tx_q     = None,
+                       io_mode  = IO_STREAM,
+                       coalesce_ms    = _TX_COALESCE_MS,    # 0 disables
+                       coalesce_bytes = _TX_COALESCE_BYTES,
+                       tx_max_bytes   = _TX_Q_MAX_BYTES,
                        ):
         self._name  = 'WIFISOCK'
+        self.io_mode = io_mode
 
         self.wifi = ifce
         # self.rtr_ifce = ifce
@@ -47,14 +63,17 @@ class WifiSocket(DebugMixin):
         self.en_ssl = en_ssl
         self.addr_info = None
 
-        self.rx_q   = PriorityQueue()
+        # socket reads go straight into the reassembly buffer of the protocol
+        self.rx_stream = RxStream()
 
         # use provided tx_q, or create our own
         if not tx_q:
-            self.tx_q   = PriorityQueue()
+            self.tx_q   = LevelQueue(max_bytes = tx_max_bytes)
         else:
             self.tx_q   = tx_q
-        # self.tx_q   = PriorityQueue()
+        self.coalesce_ms = coalesce_ms
+        self.coalesce_bytes = coalesce_bytes
+        self.tx_flush = Event() # end the coalescing window now
 
         #track if a socket is open or closed, used for retry methods
         #don't set these directly, use set_socket_status(is_ready=
@@ -70,6 +89,10 @@ class WifiSocket(DebugMixin):
         self.ticks_start = time.ticks_ms()
         self.rx_count = 0    #rx bytes/sec
         self.tx_count = 0    #tx bytes/sec
+        self.rx_wakeups = 0  #rx loop wakeups/sec
+        self.tx_wakeups = 0  #tx loop wakeups/sec
+        self.tx_pkts = 0     #pkts written
+        self.tx_records = 0  #sock writes, each is a tls record
 
     async def start(self):
         await self.adebug('start')
@@ -172,6 +195,11 @@ class WifiSocket(DebugMixin):
         self.is_closed.clear()
 
 
+    # send what's queued without waiting out the coalescing window, for
+    # pingreq and other control packets
+    def flush(self):
+        self.tx_flush.set()
+
     async def rx_coro(self):
         try:
             #local access
@@ -179,26 +207,36 @@ class WifiSocket(DebugMixin):
             # socket_up_wait = self.socket_up.wait
             # socket_up_is_set = self.socket_up.is_set
             is_closed = self.is_closed.is_set
-            rx_q = self.rx_q
-            rx_q_put = rx_q.put
+            rx_stream = self.rx_stream
+            rx_stream_window = rx_stream.window
+            rx_stream_commit = rx_stream.commit
+            rx_stream_space_wait = rx_stream.space.wait
             sleep_ms = asyncio.sleep_ms
-
-            #pre-allocate buffer
-            max_len = 1024*5
-            data = bytearray(max_len)
-            mv = memoryview(data)
+            io_stream = self.io_mode == IO_STREAM
 
             # await socket_up_wait()
             # we get new sockets, after each socker up
             sock_readinto = self.sock.readinto 
+            # readiness wait, the stream queues the socket on the asyncio poller
+            stream_readinto = asyncio.StreamReader(self.sock).readinto
             while True:
                 if is_closed():
                     break
-                await sleep_ms(_SOCKET_POLL_DELAY)
-                n = sock_readinto(data)
+                self.rx_wakeups += 1
+                await rx_stream_space_wait() # parser is behind, buffer is full
+                #read straight into the parser's buffer, no copy
+                if io_stream:
+                    # try first, tls may hold decrypted data the poller can't see
+                    n = sock_readinto(rx_stream_window())
+                    if n is None: # would block, sleep until readable
+                        n = await stream_readinto(rx_stream_window())
+                    if n == 0: # readable with no data, peer closed
+                        raise Exception('socket closed by peer')
+                else:
+                    await sleep_ms(_SOCKET_POLL_DELAY)
+                    n = sock_readinto(rx_stream_window())
                 if n:
-                    #we need to pass in a copy into the queue since we will overwrite the same buffer next iteration
-                    await rx_q_put(bytes(mv[:n]))
+                    rx_stream_commit(n)
                     self.rx_count += n
                     n = 0
 
@@ -223,6 +261,14 @@ class WifiSocket(DebugMixin):
             tx_q_get = tx_q.get_nowait
             is_closed = self.is_closed.is_set
             sleep_ms = asyncio.sleep_ms
+            wait_for_ms = asyncio.wait_for_ms
+            ticks_ms = time.ticks_ms
+            ticks_diff = time.ticks_diff
+            io_stream = self.io_mode == IO_STREAM
+            coalesce_ms = self.coalesce_ms
+            coalesce_bytes = self.coalesce_bytes
+            tx_flush_is_set = self.tx_flush.is_set
+            tx_flush_clear = self.tx_flush.clear
 
             #pre-allocate buffer
             max_len = 1024*5
@@ -235,6 +281,10 @@ class WifiSocket(DebugMixin):
 
             # await socket_up.wait()
             sock_write = self.sock.write
+            # writable wait, drain() blocks on the asyncio poller until sent
+            stream = asyncio.StreamWriter(self.sock, {})
+            stream_write = stream.write
+            stream_drain = stream.drain
             while True:
                 idx = 0
                 cnt = 0
@@ -243,39 +293,62 @@ class WifiSocket(DebugMixin):
                 if is_closed():
                     break
                 await tx_q_wait() #wait for item without getting item
-                while True:
-                    if tx_q_empty():
+                self.tx_wakeups += 1
+                ticks_start = ticks_ms()
+                while True: # coalescing window
+                    full = False
+                    while True:
+                        if tx_q_empty():
+                            break
+                        next_len = tx_q_peek_len()
+                        if not next_len:
+                            continue
+                        if idx == 0 and next_len > max_len: #the data is bigger than the buffer -> grow the buffer
+                            max_len = next_len
+                            data = bytearray(max_len)
+                            mv = memoryview(data)
+                        if idx+next_len > max_len:
+                            full = True
+                            break
+                        mv[idx:idx+next_len] = tx_q_get()
+                        # print('tx_coro 1', next_len)
+                        idx += next_len
+                        cnt += 1
+                    if full or tx_flush_is_set() or idx >= coalesce_bytes:
+                        break
+                    wait_ms = coalesce_ms - ticks_diff(ticks_ms(), ticks_start)
+                    if wait_ms <= 0:
                         break
-                    next_len = tx_q_peek_len()
-                    if not next_len:
-                        continue
-                    if idx == 0 and next_len > max_len: #the data is bigger than the buffer -> grow the buffer
-                        max_len = next_len
-                        data = bytearray(max_len)
-                        mv = memoryview(data)
-                    if idx+next_len > max_len:
+                    try:
+                        await wait_for_ms(tx_q_wait(), wait_ms) # more to batch
+                    except asyncio.TimeoutError:
                         break
-                    mv[idx:idx+next_len] = tx_q_get()
-                    # print('tx_coro 1', next_len)
-                    idx += next_len
-                    cnt += 1
+                tx_flush_clear()
                 n = 0
                 while n < idx:
                     # write returns None if not successful instead of raising EAGAIN like send
                     r = sock_write(mv[n:idx])
-                    if not r: #None or 0
+                    self.tx_records += 1
+                    if r:
+                        n += r
+                        await sleep_ms(0) #release scheduling to asyncio
+                    elif io_stream:
+                        # socket is full, hand the rest to the stream and
+                        # sleep until it's written out
+                        stream_write(mv[n:idx])
+                        await stream_drain()
+                        n = idx
+                    else: #None or 0
                         await self.adebug('tx_coro', r)
                         # await sleep_ms(100)
                         await sleep_ms(0)
                         errcnt += 1
-                    else:
-                        n += r
-                        await sleep_ms(0) #release scheduling to asyncio
                     if errcnt > 3:
                         raise Exception('sock write errored out')
 
                 #throughput
                 self.tx_count += n
+                self.tx_pkts += cnt
 
                     # alternative version with send.  send throws EAGAIN, requires a try block
                     # try:
@@ -330,11 +403,24 @@ class WifiSocket(DebugMixin):
                 #throughput report
                 ticks = time.ticks_diff(time.ticks_ms(), self.ticks_start)
                 await adebug( 'RX B/s',round(self.rx_count/(ticks/1000),1),
-                              'TX B/s',round(self.tx_count/(ticks/1000),1),)
+                              'TX B/s',round(self.tx_count/(ticks/1000),1),
+                              'RX wake/s',round(self.rx_wakeups/(ticks/1000),1),
+                              'TX wake/s',round(self.tx_wakeups/(ticks/1000),1),
+                              'TX rec/pkt',round(self.tx_records/self.tx_pkts,2) if self.tx_pkts else 0,)
+                await adebug( 'RX hw B',self.rx_stream.idx_hw,
+                              'TX q hw',self.tx_q.count_hw,
+                              'TX q hw B',self.tx_q.nbytes_hw,
+                              'TX q drop',self.tx_q.dropped,)
+                self.rx_stream.idx_hw = self.rx_stream.idx
+                self.tx_q.reset_stats()
                 # await adebug('---------')
                 self.ticks_start = time.ticks_ms()
                 self.rx_count = 0
                 self.tx_count = 0
+                self.rx_wakeups = 0
+                self.tx_wakeups = 0
+                self.tx_pkts = 0
+                self.tx_records = 0
         except asyncio.CancelledError:
             raise
         except Exception as err:
@@ -0,0 +1,236 @@
+
+# Benchmark of mqtt.encdec, the split/decode/encode path every byte on the
+# socket goes through.  Runs under the micropython unix port or CPython.
+#   micropython tools/bench_encdec.py            run and print
+#   micropython tools/bench_encdec.py --save     store as the baseline
+#   micropython tools/bench_encdec.py --check    fail on regression vs baseline
+# Baselines are kept per implementation in tools/baselines/encdec.json.
+#
+# pkts/s depends on the host, each run also times a fixed reference loop
+# that doesn't touch encdec and the check compares pkts/s relative to it
+# (rel) with the baseline's.  The baseline is still best taken on the host
+# that checks against it.
+# alloc is heap bytes allocated per packet on micropython (gc.mem_alloc).
+# CPython frees as it goes, there it is the tracemalloc peak per packet,
+# the most held at once, and printed as peak.
+
+import sys
+import gc
+import time
+import json
+
+sys.path.insert(0, 'tools')
+
+import sim
+sim.install()
+
+from mqtt import encdec as mqtt_encdec
+
+BASELINE_PATH = 'tools/baselines/encdec.json'
+IMPL = sys.implementation.name
+
+ALLOC_LABEL = 'alloc B' if IMPL == 'micropython' else 'peak B'
+
+RUN_US      = 100_000 # run each round of a case for at least this long
+ROUNDS      = 3       # best of
+PPS_SLACK   = 0.8     # regression if rel drops below 80% of baseline
+ALLOC_SLACK = 1.1     # or allocates 10% more
+
+ticks_us = time.ticks_us
+ticks_diff = time.ticks_diff
+
+#################################################################
+# packets
+def publish(topic, size, qos=0, packet_id=None):
+    payload = bytes((i*31) & 0xff for i in range(size))
+    return bytes(mqtt_encdec.encode_publish(topic     = topic,
+                                            payload   = payload,
+                                            qos       = qos,
+                                            packet_id = packet_id,
+                                            retain    = False))
+
+PINGRESP = bytes([0xd0, 0x00])
+PUBACK   = bytes([0x40, 0x02, 0x12, 0x34])
+SUBACK   = bytes([0x90, 0x03, 0x12, 0x34, 0x01])
+PUB_64   = publish(b'ki5tof/test', 64)
+PUB_OTA  = publish(b'ki5tof/ota/123', 5*1024-32, qos=1, packet_id=123)
+
+MIXED = [PINGRESP, PUBACK, PUB_64, SUBACK, PUB_OTA, PUBACK, PUB_64, PINGRESP]
+
+#################################################################
+# measurements
+def alloc_per(fn, n):
+    if IMPL == 'micropython':
+        gc.collect()
+        gc.disable()
+        a = gc.mem_alloc()
+        fn()
+        b = gc.mem_alloc()
+        gc.enable()
+        return (b - a)/n
+    import tracemalloc
+    tracemalloc.start()
+    fn()
+    (cur, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak/n
+
+# fn() processes npkts packets of nbytes total, returns (pkts/s, B/s, alloc B/pkt)
+def measure(fn, npkts, nbytes):
+    fn() # warm up
+    best = 0
+    for _ in range(ROUNDS):
+        itr = 0
+        t = ticks_us()
+        while True:
+            fn()
+            itr += 1
+            us = ticks_diff(ticks_us(), t)
+            if us >= RUN_US:
+                break
+        best = max(best, itr*1_000_000/us)
+    return (npkts*best,
+            nbytes*best,
+            alloc_per(fn, npkts))
+
+def split_case(pkts):
+    stream = b''.join(pkts)
+    mv = memoryview(stream)
+    n = len(stream)
+    splits = mqtt_encdec.new_splits(len(pkts))
+    scan = mqtt_encdec.scan_pkts
+    def fn():
+        scan(mv, n, splits)
+        assert splits[0] == len(pkts)
+    return (fn, len(pkts), len(stream))
+
+def decode_case(pkts):
+    mvs = [memoryview(p) for p in pkts]
+    decode = mqtt_encdec.decode
+    def fn():
+        for mv in mvs:
+            decode(mv)
+    return (fn, len(pkts), sum(len(p) for p in pkts))
+
+def encode_publish_case(topic, size, qos):
+    payload = bytes(size)
+    encode_publish = mqtt_encdec.encode_publish
+    nbytes = len(publish(topic, size, qos, 1))
+    def fn():
+        encode_publish(topic     = topic,
+                       payload   = payload,
+                       qos       = qos,
+                       packet_id = 1)
+    return (fn, 1, nbytes)
+
+# the MQTTCore.rx_coro path, socket reads of frag bytes appended to a
+# reassembly buffer, split, decoded and the residue compacted
+def stream_case(pkts, frag):
+    stream = b''.join(pkts)
+    smv = memoryview(stream)
+    data = bytearray(16*1024)
+    mv = memoryview(data)
+    splits = mqtt_encdec.new_splits(32)
+    scan = mqtt_encdec.scan_pkts
+    decode = mqtt_encdec.decode
+    def fn():
+        idx = 0
+        n = 0
+        for off in range(0, len(stream), frag):
+            chunk = smv[off:off+frag]
+            mv[idx:idx+len(chunk)] = chunk
+            idx += len(chunk)
+            buff_from = scan(mv, idx, splits)
+            for k in range(1, 1+2*splits[0], 2):
+                decode(mv[splits[k]:splits[k+1]])
+                n += 1
+            mv[0:idx-buff_from] = mv[buff_from:idx]
+            idx = idx-buff_from
+        assert n == len(pkts)
+    return (fn, len(pkts), len(stream))
+
+CASES = [
+    ('split pingresp',   split_case([PINGRESP]*64)),
+    ('split puback',     split_case([PUBACK]*64)),
+    ('split pub64',      split_case([PUB_64]*16)),
+    ('split ota5k',      split_case([PUB_OTA])),
+    ('split mixed',      split_case(MIXED)),
+    ('decode pingresp',  decode_case([PINGRESP])),
+    ('decode puback',    decode_case([PUBACK])),
+    ('decode suback',    decode_case([SUBACK])),
+    ('decode pub64',     decode_case([PUB_64])),
+    ('decode ota5k',     decode_case([PUB_OTA])),
+    ('encode pub64',     encode_publish_case(b'ki5tof/test', 64, 0)),
+    ('encode ota5k',     encode_publish_case(b'ki5tof/ota/123', 5*1024-32, 1)),
+    ('stream frag5k',    stream_case(MIXED*4, 5*1024)),
+    ('stream frag536',   stream_case(MIXED*4, 536)),
+    ('stream frag64',    stream_case(MIXED*4, 64)),
+]
+
+# interpreter speed of the host, bytes indexing and slicing like the cases
+def ref_case():
+    mv = memoryview(bytes(range(256)))
+    def fn():
+        n = 0
+        for i in range(0, 256, 4):
+            n += mv[i] + len(mv[i:i+4])
+        return n
+    return (fn, 64, 256)
+
+#################################################################
+def load_baselines():
+    try:
+        with open(BASELINE_PATH) as f:
+            return json.load(f)
+    except OSError:
+        return {}
+
+def save_baselines(baselines):
+    try:
+        import os
+        os.mkdir(BASELINE_PATH.rsplit('/', 1)[0])
+    except OSError:
+        pass
+    with open(BASELINE_PATH, 'w') as f:
+        json.dump(baselines, f)
+
+def main():
+    save = '--save' in sys.argv
+    check = '--check' in sys.argv
+    baselines = load_baselines()
+    base = baselines.get(IMPL, {})
+    base_cases = base.get('cases', {})
+    results = {}
+    regressions = []
+
+    (fn, npkts, nbytes) = ref_case()
+    ref = measure(fn, npkts, nbytes)[0]
+    print(IMPL, 'ref {:.0f}/s'.format(ref), 'baseline ref {:.0f}/s'.format(base['ref']) if base else '')
+    print('{:<18} {:>12} {:>12} {:>8} {:>10} {:>8}'.format('case', 'pkts/s', 'B/s', 'rel', ALLOC_LABEL, 'vs base'))
+    for (name, (fn, npkts, nbytes)) in CASES:
+        (pps, bps, alloc) = measure(fn, npkts, nbytes)
+        rel = pps/ref
+        results[name] = {'pps': pps, 'bps': bps, 'rel': rel, 'alloc': alloc}
+        vs = ''
+        if name in base_cases:
+            b = base_cases[name]
+            vs = '{:.2f}x'.format(rel/b['rel'])
+            if rel < b['rel']*PPS_SLACK or alloc > b['alloc']*ALLOC_SLACK + 8:
+                regressions.append(name)
+                vs += ' !'
+        print('{:<18} {:>12.0f} {:>12.0f} {:>8.3f} {:>10.1f} {:>8}'.format(name, pps, bps, rel, alloc, vs))
+
+    if save:
+        baselines[IMPL] = {'ref': ref, 'cases': results}
+        save_baselines(baselines)
+        print('saved', BASELINE_PATH)
+    if check:
+        if not base:
+            print('no {} baseline in {}'.format(IMPL, BASELINE_PATH))
+            sys.exit(1)
+        if regressions:
+            print('REGRESSED', regressions)
+            sys.exit(1)
+        print('ok')
+
+main()
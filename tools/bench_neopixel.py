@@ -0,0 +1,67 @@
+
+# Host side benchmark of NeoPixel buffer fills, per pixel __setitem__ vs the
+# bulk blit_mask/blit_rgb.  Runs under the micropython unix port (where viper
+# is compiled) or CPython (where viper functions run as plain python).
+#   micropython tools/bench_neopixel.py
+#   python3 tools/bench_neopixel.py
+
+import sys
+import time
+
+sys.path.insert(0, 'tools')
+
+import sim
+sim.install()
+
+from machine import Pin
+from neopixel import NeoPixel
+
+ticks_us = time.ticks_us
+ticks_diff = time.ticks_diff
+
+N   = 320
+W   = 40 # pixels per row
+ITR = 200
+
+ON  = (10, 20, 30)
+OFF = (0, 0, 0)
+
+def bench(name, fn, nbytes):
+    fn() # warm up
+    t = ticks_us()
+    for _ in range(ITR):
+        fn()
+    us = ticks_diff(ticks_us(), t)
+    print('{:<12} {:>9.1f} us/frame {:>8.3f} B/us'.format(name, us/ITR, nbytes*ITR/us))
+    return us
+
+def main():
+    neo = NeoPixel(Pin(0), N)
+    mask = bytearray(W) # 1bpp MONO_VLSB, 8 rows
+    for x in range(W):
+        mask[x] = (x*37) & 0xff
+    rgb = bytearray(N*3)
+    for i in range(N*3):
+        rgb[i] = i & 0xff
+    nbytes = len(neo.buf)
+
+    def setitem_mask():
+        for i in range(N):
+            neo[i] = ON if mask[i%W]&(1<<(i//W)) else OFF
+    def blit_mask():
+        neo.blit_mask(mask, ON, OFF, W)
+    def setitem_rgb():
+        for i in range(N):
+            neo[i] = rgb[i*3:i*3+3]
+    def blit_rgb():
+        neo.blit_rgb(rgb)
+
+    print('{} pixels, {} B/frame, {} frames'.format(N, nbytes, ITR))
+    a = bench('setitem mask', setitem_mask, nbytes)
+    b = bench('blit_mask', blit_mask, nbytes)
+    print('  x{:.1f}'.format(a/b))
+    a = bench('setitem rgb', setitem_rgb, nbytes)
+    b = bench('blit_rgb', blit_rgb, nbytes)
+    print('  x{:.1f}'.format(a/b))
+
+main()
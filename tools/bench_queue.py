@@ -0,0 +1,179 @@
+
+# Benchmark of the socket/mqtt queues, wifi.levelqueue.LevelQueue against
+# the list based queues it replaced.  Runs under the micropython unix port
+# or CPython.
+#   micropython tools/bench_queue.py
+#
+# Each case holds the queue at a depth and runs the tx_coro pattern,
+# put, peek_len, get_nowait, once per item.  alloc is heap bytes allocated
+# per item, gc.mem_alloc on micropython and tracemalloc peak on CPython.
+# lib.priorityqueue is outside this tree, if it isn't on the path a model
+# of it is measured instead, a priority and a normal list, pop(0), and a
+# put event (set/clear like primitives.queue) for the wait() tx_coro
+# awaits.  lists is the model without the event, the bare list cost, a
+# floor no queue that can be waited on reaches.
+# LevelQueue/lists is LevelQueue with its levels on lists, pop(0), as
+# PriorityQueue's are.  Same byte budget, drop and stats bookkeeping, it
+# sets the ring against the list alone, LevelQueue against PriorityQueue
+# includes the bookkeeping PriorityQueue doesn't do.
+
+import sys
+import gc
+import time
+
+sys.path.insert(0, 'tools')
+
+import sim
+sim.install()
+
+from wifi.levelqueue import LevelQueue
+from primitives.queue import Queue
+
+IMPL = sys.implementation.name
+
+RUN_US  = 100_000 # run each case for at least this long
+ROUNDS  = 3       # best of
+ITEMS   = 256     # items through the queue per run
+DEPTHS  = (1, 16, 200)
+PKT     = bytes(64)
+PRIO    = 4       # every PRIO'th item is priority
+
+ticks_us = time.ticks_us
+ticks_diff = time.ticks_diff
+
+class ListQueue:
+    def __init__(self):
+        self._p_queue = []
+        self._queue = []
+
+    def put_nowait(self, v, is_priority=False):
+        (self._p_queue if is_priority else self._queue).append(v)
+
+    def peek_len(self):
+        return len(self._p_queue[0] if self._p_queue else self._queue[0])
+
+    def get_nowait(self):
+        return self._p_queue.pop(0) if self._p_queue else self._queue.pop(0)
+
+try:
+    from lib.priorityqueue import PriorityQueue
+except ImportError:
+    from asyncio import Event
+    class PriorityQueue:
+        def __init__(self):
+            self._p_queue = []
+            self._queue = []
+            self._evput = Event()
+
+        def put_nowait(self, v, is_priority=False):
+            (self._p_queue if is_priority else self._queue).append(v)
+            self._evput.set()
+            self._evput.clear()
+
+        def peek_len(self):
+            return len(self._p_queue[0] if self._p_queue else self._queue[0])
+
+        def get_nowait(self):
+            return self._p_queue.pop(0) if self._p_queue else self._queue.pop(0)
+
+class ListLevelQueue(LevelQueue):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for r in self.levels:
+            r.items = []
+            r.meta = []
+
+    def take(self, r):
+        v = r.items.pop(0)
+        self.nbytes -= r.meta.pop(0) >> 1
+        self.count -= 1
+        if self.putters:
+            self.evget.set()
+            self.evget.clear()
+        return v
+
+    def get_nowait(self):
+        r = self.hi
+        if not r.items:
+            r = self.lo
+            if not r.items:
+                raise IndexError
+        v = r.items.pop(0)
+        self.nbytes -= r.meta.pop(0) >> 1
+        self.count -= 1
+        if self.putters:
+            self.evget.set()
+            self.evget.clear()
+        return v
+
+# primitives.queue.Queue has no priority or peek_len
+class FifoQueue(Queue):
+    def put_nowait(self, v, is_priority=False):
+        super().put_nowait(v)
+
+    def peek_len(self):
+        return len(self._queue[0])
+
+def alloc_per(fn, n):
+    if IMPL == 'micropython':
+        gc.collect()
+        gc.disable()
+        a = gc.mem_alloc()
+        fn()
+        b = gc.mem_alloc()
+        gc.enable()
+        return (b - a)/n
+    import tracemalloc
+    tracemalloc.start()
+    fn()
+    (cur, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak/n
+
+def case(q, depth):
+    for i in range(depth):
+        q.put_nowait(PKT, i % PRIO == 0)
+    put = q.put_nowait
+    peek_len = q.peek_len
+    get = q.get_nowait
+    def fn():
+        n = 0
+        for i in range(ITEMS):
+            put(PKT, i % PRIO == 0)
+            n += peek_len()
+            get()
+        assert n == ITEMS*len(PKT)
+    return fn
+
+def measure(fn):
+    fn() # warm up
+    best = 0
+    for _ in range(ROUNDS):
+        itr = 0
+        t = ticks_us()
+        while True:
+            fn()
+            itr += 1
+            us = ticks_diff(ticks_us(), t)
+            if us >= RUN_US:
+                break
+        best = max(best, itr*1_000_000/us)
+    return (ITEMS*best, alloc_per(fn, ITEMS))
+
+QUEUES = [
+    ('LevelQueue',    lambda: LevelQueue(sizes=(64, 256))),
+    ('LevelQueue/lists', lambda: ListLevelQueue(sizes=(64, 256))),
+    ('PriorityQueue', lambda: PriorityQueue()),
+    ('Queue',         lambda: FifoQueue()),
+    ('lists',         lambda: ListQueue()),
+]
+
+def main():
+    print(IMPL)
+    print('{:<16} {:>6} {:>12} {:>10}'.format('queue', 'depth', 'items/s', 'alloc B'))
+    for depth in DEPTHS:
+        for (name, make) in QUEUES:
+            (ips, alloc) = measure(case(make(), depth))
+            print('{:<16} {:>6} {:>12.0f} {:>10.1f}'.format(name, depth, ips, alloc))
+
+main()
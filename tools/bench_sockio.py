@@ -0,0 +1,72 @@
+
+# Benchmark of WifiSocket io modes, readiness driven IO_STREAM vs the
+# IO_SLEEP polling fallback, against tools/tls_echo_server.py.  Runs under
+# the micropython unix port (socket.readinto and tls are micropython APIs)
+# with lib/ on the path, as on the device.
+#   python3 tools/tls_echo_server.py &
+#   micropython tools/bench_sockio.py [port]
+#
+# idle wake/s is loop wakeups per second with no traffic, rtt is the time
+# from tx_q.put to the echo landing in rx_stream.
+
+import sys
+import time
+
+sys.path.insert(0, 'tools')
+
+import sim
+sim.install()
+
+import asyncio
+from wifi.wifi import WifiSocket
+from wifi.wifi import IO_STREAM
+from wifi.wifi import IO_SLEEP
+
+PORT    = int(sys.argv[1]) if len(sys.argv) > 1 else 8883
+IDLE_S  = 2
+ROUNDS  = 200
+MSG_LEN = 64
+
+ticks_us = time.ticks_us
+ticks_diff = time.ticks_diff
+
+async def bench(name, io_mode):
+    async with WifiSocket(host    = '127.0.0.1',
+                          port    = PORT,
+                          en_ssl  = True,
+                          io_mode = io_mode,
+                          ) as sock:
+        rx_stream = sock.rx_stream
+        msg = bytes(range(MSG_LEN))
+
+        # idle wakeups
+        await asyncio.sleep(0.2)
+        sock.rx_wakeups = 0
+        sock.tx_wakeups = 0
+        await asyncio.sleep(IDLE_S)
+        rx_idle = sock.rx_wakeups/IDLE_S
+        tx_idle = sock.tx_wakeups/IDLE_S
+
+        # round trips
+        rtts = []
+        sock.rx_wakeups = 0
+        for _ in range(ROUNDS):
+            t = ticks_us()
+            await sock.tx_q.put(msg)
+            while rx_stream.idx < MSG_LEN:
+                await rx_stream.wait()
+            rtts.append(ticks_diff(ticks_us(), t))
+            rx_stream.consume(MSG_LEN)
+        rtts.sort()
+        print('{:<10} {:>10.1f} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.1f}'.format(
+            name, rx_idle, tx_idle,
+            rtts[len(rtts)//2]/1000, rtts[len(rtts)*99//100]/1000,
+            sock.rx_wakeups/ROUNDS))
+
+async def run():
+    print('{:<10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'mode', 'rx wake/s', 'tx wake/s', 'rtt50 ms', 'rtt99 ms', 'rx wake/rt'))
+    await bench('stream', IO_STREAM)
+    await bench('sleep', IO_SLEEP)
+
+asyncio.run(run())
@@ -1,50 +1,380 @@
 
 import asyncio
+import binascii
+import hashlib
 import sys
-from aiomqtt import Client, MqttError
 import ssl
+import time
 import zlib
-import rich.progress
 
 FW_PATH = '/home/ssmith/micropython/ports/esp32/build-BLING/micropython.bin' # the ota parition
 OTA_BLOCK_SIZE = 4096
+MQTT_ROOT = 'ki5tof'
+
+CHUNK_PAGES = 4   # pages per publish, chunk size is CHUNK_PAGES*OTA_BLOCK_SIZE, at most 255
+MAX_PACKET  = 32*1024 # the device's mqtt 5 Maximum Packet Size (its rx buffer's max_size),
+                      # a broker drops a bigger publish.  plan() cuts chunks to fit.
+PACKET_OVERHEAD = 64  # fixed header, topic and properties of a chunk publish
+WINDOW      = 4   # initial chunks in flight
+WINDOW_MAX  = 16
+ACK_TIMEOUT = 5.0 # s, initial, adapts to the ack round trip
+ACK_TIMEOUT_MIN = 1.0
+ACK_TIMEOUT_MAX = 30.0
+QUEUED_MIN  = 1   # chunks, keep at least this many waiting at the device
+QUEUED_MAX  = 3
+MANIFEST_TIMEOUT = 10.0 # s, wait for the device's crcs, then send everything
+DONE_TRIES = 3 # the device reboots after acking done, don't wait forever
 
 def int_div_ceil(total_size, chunk_size):
     return total_size//chunk_size + (1 if total_size%chunk_size else 0)
 
-async def publish_async_message():
+# the changed pages are one zlib stream, 4KB window so the device's inflate
+# window stays small.  A bigger window compresses better (wbits=15, ~6% on
+# micropython.bin) for 2**wbits bytes of device heap during the transfer.
+WBITS = 12
+
+# ccrc.crc16_ccit, crc-16/x-25
+X25_TABLE = []
+for i in range(256):
+    c = i
+    for _ in range(8):
+        c = (c >> 1) ^ 0x8408 if c & 1 else c >> 1
+    X25_TABLE.append(c)
+
+def crc16_x25(data):
+    crc = 0xffff
+    table = X25_TABLE
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xff]
+    return crc ^ 0xffff
+
+# start page of a chunk (b'12') or copy (b'c12') ack, None for others
+def key_page(key):
+    if key[-1:].isdigit():
+        return int(key[1:] if key[:1] == b'c' else key)
+    return None
+
+# manifest entry of a page, ccrc.crc16 (xmodem) then ccrc.crc16_ccit
+def page_crcs(page):
+    page = page + b'\xff'*(OTA_BLOCK_SIZE-len(page)) # erased flash
+    return binascii.crc_hqx(page, 0).to_bytes(2, 'big') + crc16_x25(page).to_bytes(2, 'big')
+
+# Windowed ota sender, see src/ota.py for the device side.
+#   <root>/ota/start    image size in pages, acked
+#   <root>/ota/manifest delta mode, the device replies with the crcs of its
+#                       running image on <root>/ota/crcs
+#   <root>/ota/chunk    up to CHUNK_PAGES changed pages, acked with the
+#                       start page.  The start page (2 bytes, big endian),
+#                       the page count (1 byte) then the next piece of the
+#                       image's zlib stream, sync flushed so the device can
+#                       inflate every page of the chunk
+#   <root>/ota/copy     up to CHUNK_PAGES unchanged pages to copy from the
+#                       running image, the start page (2 bytes) and the
+#                       count (1 byte), acked with c<start page>
+#   <root>/ota/done     sha256 of the image, after every chunk was acked
+# Without a manifest (delta off or no reply) every page is sent.
+# The page is in the payload so the topics repeat, they're interned by the
+# device's router and an mqtt 5 broker can alias them.
+# The chunks are one solid stream, back references reach into earlier
+# chunks.  The device takes them in order so a go-back re-sends the same
+# piece of the stream, a new plan starts a new stream and the device's
+# nack of page 0 (it was reset) restarts it from the first chunk.
+# The device takes pages in order, a nack on <root>/ota/nack carries the page
+# it expects and the sender goes back to it (go-back-n).  A nack of page 0
+# after done is a digest mismatch, the full image is sent again.
+# Keeps up to window chunks in flight.  Comparing each ack round trip with
+# the fastest seen estimates how many chunks are queued at the broker or
+# device (as tcp vegas does), the window grows while fewer than
+# QUEUED_MIN are queued and shrinks above QUEUED_MAX.  A timeout halves it
+# and re-sends the chunk.
+#   publish  async fn(topic, payload), the mqtt client
+#   on_msg() is to be called with the last topic level and payload of each
+#   <root>/ota/ack, <root>/ota/nack and <root>/ota/crcs
+class OTASender:
+    def __init__(self, publish,
+                       fw,
+                       chunk_pages = CHUNK_PAGES,
+                       window      = WINDOW,
+                       window_max  = WINDOW_MAX,
+                       root        = MQTT_ROOT,
+                       progress    = None,  # fn(msgs done, msgs total)
+                       delta       = True,
+                       ):
+        self.publish = publish
+        self.root = root
+        self.progress = progress
+        self.chunk_pages = chunk_pages
+        self.delta = delta
+        self.num_pages = int_div_ceil(len(fw), OTA_BLOCK_SIZE)
+        pad = self.num_pages*OTA_BLOCK_SIZE - len(fw)
+        self.fw = fw + b'\xff'*pad # whole pages, as erased flash
+        self.msgs = []
+        self.msg_idxs = {} # start page -> index in msgs
+        # msgs are (ack key, topic level, payload)
+        self.crcs = None
+        self.crcs_evt = asyncio.Event()
+        self.nack_page = 0
+        self.nack_evt = asyncio.Event()
+        self.goback_page = None
+        self.goback_t = 0
+
+        self.window = float(window)
+        self.window_max = window_max
+        self.pending = {} # ack payload -> Event
+        self.srtt = None
+        self.min_rtt = None
+        self.ack_timeout = ACK_TIMEOUT
+
+        #stats
+        self.sent = 0
+        self.resent = 0
+        self.bytes_sent = 0
+        self.copies = 0 # pages the device copies
+        self.gobacks = 0
+
+    def on_msg(self, lvl, payload):
+        if lvl == 'ack':
+            self.on_ack(payload)
+        elif lvl == 'nack':
+            self.on_nack(payload)
+        elif lvl == 'crcs':
+            self.crcs = bytes(payload)
+            self.crcs_evt.set()
+
+    # acks are cumulative, the device takes pages in order so an ack of a
+    # page covers every message before it, a lost ack costs no re-send
+    def on_ack(self, payload):
+        key = bytes(payload)
+        page = key_page(key)
+        for (k, evt) in self.pending.items():
+            k_page = key_page(k)
+            if k == key or page is not None and k_page is not None and k_page < page:
+                evt.set()
+
+    def on_nack(self, payload):
+        self.nack_page = int(bytes(payload))
+        self.nack_evt.set()
+        evt = self.pending.get(b'done')
+        if evt:
+            evt.set() # answered, with a nack
+
+    # sha256 of the image as the device writes it, whole 0xff padded pages
+    def digest(self):
+        return hashlib.sha256(self.fw).digest()
+
+    # crcs of the running image on the device, None if it doesn't answer
+    async def get_manifest(self):
+        self.crcs_evt.clear()
+        await self.publish(f'{self.root}/ota/manifest', str(self.num_pages).encode())
+        try:
+            await asyncio.wait_for(self.crcs_evt.wait(), MANIFEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            print('no manifest, sending the full image')
+            return None
+        return self.crcs
+
+    # the messages to send, runs of changed pages as chunks and unchanged
+    # pages as copies
+    def plan(self, crcs):
+        fw = self.fw
+        n = self.num_pages
+        changed = [crcs is None or 4*page+4 > len(crcs) or
+                   page_crcs(fw[page*OTA_BLOCK_SIZE:(page+1)*OTA_BLOCK_SIZE]) != crcs[4*page:4*page+4]
+                   for page in range(n)]
+        msgs = []
+        self.msg_idxs = {}
+        self.copies = 0
+        c = zlib.compressobj(9, zlib.DEFLATED, WBITS)
+        page = 0
+        while page < n:
+            self.msg_idxs[page] = len(msgs)
+            end = page
+            while end < n and changed[end] == changed[page] and end-page < self.chunk_pages:
+                end += 1
+            if changed[page]:
+                # fewer pages if the publish wouldn't fit MAX_PACKET, the
+                # stream is compressed on a copy until it does
+                while True:
+                    t = c.copy()
+                    data = t.compress(fw[page*OTA_BLOCK_SIZE:end*OTA_BLOCK_SIZE]) + t.flush(zlib.Z_SYNC_FLUSH)
+                    if end-page == 1 or len(data)+PACKET_OVERHEAD <= MAX_PACKET:
+                        break
+                    end -= 1
+                c = t
+                msgs.append((str(page), 'chunk', page.to_bytes(2, 'big') + bytes([end-page]) + data))
+            else:
+                msgs.append((f'c{page}', 'copy', page.to_bytes(2, 'big') + bytes([end-page])))
+                self.copies += end-page
+            page = end
+        return msgs
+
+    def on_rtt(self, rtt):
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.srtt = rtt if self.srtt is None else 0.875*self.srtt + 0.125*rtt
+        self.ack_timeout = min(ACK_TIMEOUT_MAX, max(ACK_TIMEOUT_MIN, 4*self.srtt))
+        queued = self.window*(1 - self.min_rtt/rtt)
+        if queued < QUEUED_MIN:
+            self.window = min(self.window_max, self.window + 1/self.window)
+        elif queued > QUEUED_MAX:
+            self.window = max(1.0, self.window - 1/self.window)
+
+    def on_timeout(self):
+        self.window = max(1.0, self.window/2)
+        self.ack_timeout = min(ACK_TIMEOUT_MAX, self.ack_timeout*2)
+
+    # publish to <root>/ota/<lvl> and wait for the ack key, re-send on
+    # timeout.  Returns False if there was no ack after tries.
+    async def send(self, key, lvl, payload, tries=None):
+        key = key.encode()
+        evt = asyncio.Event()
+        self.pending[key] = evt
+        try:
+            while tries is None or tries > 0:
+                if tries:
+                    tries -= 1
+                t = time.monotonic()
+                await self.publish(f'{self.root}/ota/{lvl}', payload)
+                self.sent += 1
+                self.bytes_sent += len(payload)
+                try:
+                    await asyncio.wait_for(evt.wait(), self.ack_timeout)
+                    if lvl != 'start' and lvl != 'done':
+                        self.on_rtt(time.monotonic()-t)
+                    return True
+                except asyncio.TimeoutError:
+                    self.on_timeout()
+                    self.resent += 1
+            return False
+        finally:
+            if self.pending.get(key) is evt: # not a re-send of a go-back
+                del self.pending[key]
+
+    # go back to the page the device nacked, nacks of the messages behind a
+    # lost one all carry the same page, go back once per ack timeout
+    def goback(self, idx, inflight):
+        self.nack_evt.clear()
+        page = self.nack_page
+        now = time.monotonic()
+        if page == self.goback_page and now-self.goback_t < self.ack_timeout:
+            return idx
+        self.goback_page = page
+        self.goback_t = now
+        self.gobacks += 1
+        for task in inflight:
+            task.cancel()
+        inflight.clear()
+        return self.msg_idxs.get(page, idx)
+
+    # send msgs from idx with up to window in flight
+    async def send_msgs(self, idx):
+        msgs = self.msgs
+        inflight = set()
+        nack_wait = None
+        try:
+            while idx < len(msgs) or inflight:
+                if self.nack_evt.is_set():
+                    idx = self.goback(idx, inflight)
+                while idx < len(msgs) and len(inflight) < int(self.window):
+                    (key, lvl, payload) = msgs[idx]
+                    inflight.add(asyncio.create_task(self.send(key, lvl, payload)))
+                    idx += 1
+                    if self.progress:
+                        self.progress(idx-1, len(msgs))
+                if nack_wait is None or nack_wait.done():
+                    nack_wait = asyncio.create_task(self.nack_evt.wait())
+                done, _ = await asyncio.wait(inflight | {nack_wait}, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is not nack_wait:
+                        inflight.discard(task)
+                        task.result()
+        finally:
+            for task in inflight:
+                task.cancel()
+            if nack_wait:
+                nack_wait.cancel()
+
+    # returns the transfer time in s
+    async def run(self):
+        t = time.monotonic()
+        await self.send('start', 'start', str(self.num_pages).encode())
+        self.msgs = self.plan(await self.get_manifest() if self.delta else None)
+        digest = self.digest()
+        idx = 0
+        while True:
+            await self.send_msgs(idx)
+            self.nack_evt.clear()
+            if not await self.send('done', 'done', digest, tries=DONE_TRIES):
+                print('no ack for done, the device may have rebooted already')
+                break
+            if not self.nack_evt.is_set():
+                break # verified, the device boots the new image
+            self.nack_evt.clear()
+            if self.nack_page == 0:
+                print('digest mismatch, sending the full image')
+                self.msgs = self.plan(None)
+            idx = self.msg_idxs.get(self.nack_page, 0)
+            self.gobacks += 1
+        return time.monotonic()-t
+
+    def print_stats(self, secs):
+        print('{} pages, {} copied, in {} msgs, {:.1f}s, {:.1f} KB/s, {} KB sent, {} re-sent, {} go-backs, window {:.1f}, srtt {:.0f}ms'.format(
+            self.num_pages, self.copies, len(self.msgs), secs,
+            self.num_pages*OTA_BLOCK_SIZE/1024/secs, self.bytes_sent//1024,
+            self.resent, self.gobacks, self.window, 1000*(self.srtt or 0)))
+
+async def publish_async_message(fw_path, chunk_pages, window, delta):
+    from aiomqtt import Client, MqttError
+    import rich.progress
+
+    with open(fw_path, 'rb') as f:
+        fw = f.read()
+
     # Use an asynchronous context manager to connect and disconnect automatically
     try:
-        async with Client("broker.hivemq.com", 
+        async with Client("broker.hivemq.com",
                           port=8883,
                           tls_context=ssl.create_default_context(),
                           ) as client:
-            page = 0
-            with open(FW_PATH, 'rb') as f:
-                f.seek(0, 2)
-                fsz = f.tell()
-                f.seek(0)
-                num_pages = int_div_ceil(fsz, OTA_BLOCK_SIZE)
-                print(fsz, OTA_BLOCK_SIZE, fsz/OTA_BLOCK_SIZE)
-                for page in rich.progress.track(range(num_pages)):
-                    p = f.read(OTA_BLOCK_SIZE)
-                    # b = bytearray(OTA_BLOCK_SIZE)
-                    # b[:len(p)] = p
-                    z = zlib.compress(p)
-                    print('PAGE:{}/{} {}-{}'.format(page, num_pages, len(p), len(z)))
-                    await client.publish(f'ki5tof/ota/{page}', payload=z, qos=1)
-                    # await client.publish(f'ki5tof/ota/{page}', payload=b, qos=1)
-                    await asyncio.sleep(0.75)
-            await asyncio.sleep(1)
-            await client.publish(f'ki5tof/ota/done', payload=b'\x00', qos=1)
+            async def publish(topic, payload):
+                await client.publish(topic, payload=payload, qos=1)
+
+            with rich.progress.Progress() as progress:
+                bar = progress.add_task('ota', total=1)
+                sender = OTASender(publish     = publish,
+                                   fw          = fw,
+                                   chunk_pages = chunk_pages,
+                                   window      = window,
+                                   delta       = delta,
+                                   progress    = lambda n, total: progress.update(bar, completed=n+1, total=total))
+
+                async def acks():
+                    async for message in client.messages:
+                        sender.on_msg(message.topic.value.rsplit('/', 1)[-1], message.payload)
+
+                await client.subscribe(f'{MQTT_ROOT}/ota/ack')
+                await client.subscribe(f'{MQTT_ROOT}/ota/nack')
+                await client.subscribe(f'{MQTT_ROOT}/ota/crcs')
+                ack_task = asyncio.create_task(acks())
+                try:
+                    secs = await sender.run()
+                finally:
+                    ack_task.cancel()
+            sender.print_stats(secs)
 
     except MqttError as error:
         print(f"An MQTT error occurred: {error}")
 
+#   python3 tools/pushfw.py [--full] [micropython.bin] [chunk pages] [window]
+# --full sends every page, otherwise only pages that differ from the
+# device's running image
 def main():
+    argv = [a for a in sys.argv if a != '--full']
+    delta = '--full' not in sys.argv
+    fw_path = argv[1] if len(argv) > 1 else FW_PATH
+    chunk_pages = int(argv[2]) if len(argv) > 2 else CHUNK_PAGES
+    window = int(argv[3]) if len(argv) > 3 else WINDOW
     # Run the asynchronous function using asyncio.run()
-    asyncio.run(publish_async_message())
+    asyncio.run(publish_async_message(fw_path, chunk_pages, window, delta))
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,80 @@
+
+# Host side simulator of the bling clock hardware.
+#
+# install() puts stand-ins for machine, esp32, network and lib.mytime (the
+# clock source) into sys.modules so the modules under src/ import and run
+# unmodified on the micropython unix port or CPython.  If lib itself isn't
+# on the path, lib.b62 is provided for mqtt.encdec and lib.debug,
+# byteify_pkt and cancel_gather_wait_for_ms for mqtt.core.  On CPython it
+# also provides the micropython builtins (const, viper, ptr8, ticks_ms,
+# sleep_ms, print_exception), utime, uasyncio (ThreadSafeFlag,
+# wait_for_ms), deflate and ccrc the code relies on.
+#
+#   import sim
+#   clock = sim.install(start=(2026, 10, 18, 12, 34, 56, 0))
+#   import display  # after install()
+
+import sys
+
+from .fakeclock import FakeClock
+from .hw import frames
+from .prof import Profiler
+from .prof import frame_to_ascii
+
+SRC_PATH = 'src'
+
+clock = None
+
+# lib stand-ins for mqtt.core
+class _DebugMixin:
+    def debug(self, *args):
+        if self._debug:
+            print(self._name, *args)
+
+def _byteify_pkt(v):
+    if isinstance(v, str):
+        return v.encode()
+    if isinstance(v, int):
+        return str(v).encode()
+    return v
+
+async def _cancel_gather_wait_for_ms(tasks, timeout_ms):
+    import asyncio
+    for task in tasks:
+        task.cancel()
+    await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), timeout_ms/1000)
+
+def install(start=None, src_path=SRC_PATH):
+    global clock
+    from . import upy
+    upy.install()
+
+    from . import hw
+    sys.modules['machine'] = hw.machine
+    sys.modules['esp32'] = hw.esp32
+    sys.modules['network'] = hw.network
+
+    clock = FakeClock(start)
+    try:
+        import lib
+    except ImportError:
+        lib = upy.new_module('lib')
+        sys.modules['lib'] = lib
+        b62 = upy.new_module('lib.b62')
+        b62._BASE62 = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+        sys.modules['lib.b62'] = b62
+        lib.b62 = b62
+        debug = upy.new_module('lib.debug')
+        debug.DebugMixin = _DebugMixin
+        sys.modules['lib.debug'] = debug
+        lib.debug = debug
+        lib.byteify_pkt = _byteify_pkt
+        lib.cancel_gather_wait_for_ms = _cancel_gather_wait_for_ms
+    mytime = upy.new_module('lib.mytime')
+    mytime.lcl_timetuple = clock.lcl_timetuple
+    sys.modules['lib.mytime'] = mytime
+    lib.mytime = mytime
+
+    if src_path not in sys.path:
+        sys.path.insert(0, src_path)
+    return clock
@@ -0,0 +1,25 @@
+
+# Fake clock source standing in for lib.mytime
+
+import time
+
+class FakeClock:
+    # start (yr, mth, day, hr, min, sec, msec), time runs in real time from
+    # there.  None starts before the ntp sync (yr < 2026).
+    def __init__(self, start=None):
+        self.set(start or (2000, 1, 1, 0, 0, 0, 0))
+
+    def set(self, tt):
+        (self.yr, self.mth, self.day, hr, min, sec, msec,) = tt
+        self.ms_start = ((hr*60 + min)*60 + sec)*1000 + msec
+        self.ticks_start = time.ticks_ms()
+
+    # jump the clock forward
+    def advance(self, ms):
+        self.ms_start += ms
+
+    def lcl_timetuple(self):
+        ms = self.ms_start + time.ticks_diff(time.ticks_ms(), self.ticks_start)
+        ms %= 24*60*60*1000
+        return (self.yr, self.mth, self.day,
+                ms//3600_000, (ms//60_000)%60, (ms//1000)%60, ms%1000,)
@@ -0,0 +1,136 @@
+
+# Stand-ins for machine, esp32 and network.
+# machine.bitstream records every frame written to the neopixels.
+
+import time
+
+from .upy import new_module
+
+frames = [] # (ticks_ms, bytes) of each bitstream write
+
+#################################################################
+# machine
+machine = new_module('machine')
+
+class Pin:
+    IN  = 0
+    OUT = 1
+    def __init__(self, id, mode=-1, value=None):
+        self.id = id
+        self._value = value or 0
+    def init(self, mode=-1, *args, **kwargs):
+        pass
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = v
+    def irq(self, *args, **kwargs):
+        pass
+    def __call__(self, v=None):
+        return self.value(v)
+
+def bitstream(pin, encoding, timing, buf):
+    frames.append((time.ticks_ms(), bytes(buf)))
+
+machine.Pin = Pin
+machine.bitstream = bitstream
+machine.reset = lambda: None
+machine.bootloader = lambda: None
+
+#################################################################
+# esp32
+esp32 = new_module('esp32')
+
+_BLOCK_SIZE = 4096
+
+# an in memory ota partition
+class Partition:
+    BOOT    = 0
+    RUNNING = 1
+    TYPE_APP  = 0
+    TYPE_DATA = 1
+    _parts = {}
+    _boot  = 'ota_0'
+
+    def __init__(self, id, block_size=_BLOCK_SIZE):
+        if id == Partition.RUNNING or id == Partition.BOOT:
+            id = Partition._boot
+        self.label = id
+        self.block_size = block_size
+        if id not in Partition._parts:
+            Partition._parts[id] = bytearray(b'\xff'*(256*block_size))
+        self.mem = Partition._parts[id]
+
+    @staticmethod
+    def find(type=TYPE_APP, subtype=0xff, label=None):
+        return [Partition(label)] if label else []
+
+    def info(self):
+        return (0, 0, 0, len(self.mem), self.label, False)
+
+    def get_next_update(self):
+        return Partition('ota_1' if self.label == 'ota_0' else 'ota_0')
+
+    def readblocks(self, block, buf, offset=0):
+        a = block*self.block_size + offset
+        buf[:] = self.mem[a:a+len(buf)]
+
+    def writeblocks(self, block, buf, offset=None):
+        if offset is None:
+            self.ioctl(6, block)
+            offset = 0
+        a = block*self.block_size + offset
+        self.mem[a:a+len(buf)] = buf
+
+    def ioctl(self, cmd, arg):
+        if cmd == 4: # block count
+            return len(self.mem)//self.block_size
+        if cmd == 5: # block size
+            return self.block_size
+        if cmd == 6: # erase
+            a = arg*self.block_size
+            self.mem[a:a+self.block_size] = b'\xff'*self.block_size
+            return 0
+
+    def set_boot(self):
+        Partition._boot = self.label
+
+    def mark_app_valid_cancel_rollback(self):
+        pass
+
+esp32.Partition = Partition
+
+#################################################################
+# network
+network = new_module('network')
+
+class WLAN:
+    def __init__(self, interface_id=0):
+        self._active = False
+        self._connected = False
+    def config(self, *args, **kwargs):
+        if args and args[0] == 'mac':
+            return b'\xdc\x54\x75\x00\x00\x01'
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._active
+        self._active = is_active
+    def connect(self, ssid=None, key=None):
+        self._connected = True
+    def disconnect(self):
+        self._connected = False
+    def isconnected(self):
+        return self._connected
+    def status(self):
+        return network.STAT_GOT_IP if self._connected else network.STAT_IDLE
+    def ifconfig(self):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+network.WLAN = WLAN
+network.STA_IF = 0
+network.AP_IF = 1
+network.STAT_IDLE = 1000
+network.STAT_CONNECTING = 1001
+network.STAT_GOT_IP = 1010
+network.STAT_NO_AP_FOUND = 201
+network.STAT_WRONG_PASSWORD = 202
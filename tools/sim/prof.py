@@ -0,0 +1,53 @@
+
+# Per stage timing of the render path, wraps callables in place so the code
+# under test runs unmodified.
+
+import time
+
+class Stage:
+    def __init__(self, name):
+        self.name  = name
+        self.count = 0
+        self.us    = 0
+        self.max   = 0
+
+class Profiler:
+    def __init__(self):
+        self.stages = []
+
+    # replace obj.attr with a timed wrapper, obj is a module or class
+    def wrap(self, obj, attr, name=None):
+        fn = getattr(obj, attr)
+        stage = Stage(name or attr)
+        ticks_us = time.ticks_us
+        ticks_diff = time.ticks_diff
+        def timed(*args, **kwargs):
+            t = ticks_us()
+            r = fn(*args, **kwargs)
+            us = ticks_diff(ticks_us(), t)
+            stage.count += 1
+            stage.us += us
+            if us > stage.max:
+                stage.max = us
+            return r
+        setattr(obj, attr, timed)
+        self.stages.append(stage)
+        return stage
+
+    def report(self):
+        print('{:<16} {:>8} {:>10} {:>8}'.format('stage', 'count', 'avg us', 'max us'))
+        for s in self.stages:
+            print('{:<16} {:>8} {:>10.1f} {:>8}'.format(s.name, s.count,
+                  s.us/s.count if s.count else 0, s.max))
+
+# draw a recorded neopixel frame, any lit pixel is '#'
+def frame_to_ascii(buf, width=40, bpp=3):
+    rows = []
+    n = len(buf)//bpp
+    for y in range(n//width):
+        row = ''
+        for x in range(width):
+            o = (y*width + x)*bpp
+            row += '#' if any(buf[o:o+bpp]) else '.'
+        rows.append(row)
+    return '\n'.join(rows)
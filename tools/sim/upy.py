@@ -0,0 +1,138 @@
+
+# micropython builtins for running under CPython, a no-op on micropython
+
+import sys
+import time
+
+IS_UPY = sys.implementation.name == 'micropython'
+
+# stand-in module object, works in sys.modules on both implementations
+class Module:
+    def __init__(self, name):
+        self.__name__ = name
+
+def new_module(name):
+    return Module(name)
+
+def _identity(f):
+    return f
+
+# ccrc, the C module in upy/c_modules/ccrc
+def _crc16(buf):
+    import binascii
+    return binascii.crc_hqx(buf, 0) # xmodem
+
+_X25_TABLE = []
+for _i in range(256):
+    _c = _i
+    for _ in range(8):
+        _c = (_c >> 1) ^ 0x8408 if _c & 1 else _c >> 1
+    _X25_TABLE.append(_c)
+
+def _crc16_ccit(buf):
+    crc = 0xffff
+    for b in bytes(buf):
+        crc = (crc >> 8) ^ _X25_TABLE[(crc ^ b) & 0xff]
+    return crc ^ 0xffff
+
+# deflate.DeflateIO decompression on top of zlib, reading the source as
+# the device does.  micropython's DeflateIO (uzlib) pulls the source one
+# byte at a time as it decodes, so it reads no further than the output
+# asked for needs, and a 0 byte read of the source is its eof for good,
+# the source is never read again.
+class DeflateIO:
+    def __init__(self, stream, format=0, wbits=0, close=False):
+        import zlib
+        # AUTO, RAW, ZLIB, GZIP
+        self.d = zlib.decompressobj((47, -15, 15, 31)[format])
+        self.stream = stream
+        self.close_stream = close
+        self.byte = bytearray(1)
+        self.out = b''
+        self.eof = False
+
+    def readinto(self, buf):
+        while len(self.out) < len(buf) and not self.eof and not self.d.eof:
+            if not self.stream.readinto(self.byte):
+                self.eof = True
+                break
+            self.out += self.d.decompress(self.byte)
+        n = min(len(buf), len(self.out))
+        buf[:n] = self.out[:n]
+        self.out = self.out[n:]
+        return n
+
+    def read(self, n=4096):
+        b = bytearray(n)
+        return bytes(b[:self.readinto(b)])
+
+    def close(self):
+        if self.close_stream:
+            self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# asyncio.ThreadSafeFlag, an event that clears when a waiter wakes
+def _thread_safe_flag():
+    import asyncio
+    class ThreadSafeFlag:
+        def __init__(self):
+            self.event = asyncio.Event()
+
+        def set(self):
+            self.event.set()
+
+        def clear(self):
+            self.event.clear()
+
+        async def wait(self):
+            await self.event.wait()
+            self.event.clear()
+    return ThreadSafeFlag
+
+def install():
+    if IS_UPY:
+        return
+    import builtins
+    import asyncio
+    import traceback
+
+    builtins.const = lambda x: x
+    for n in ('ptr', 'ptr8', 'ptr16', 'ptr32', 'uint'):
+        setattr(builtins, n, object)
+
+    micropython = new_module('micropython')
+    micropython.const = builtins.const
+    micropython.viper = _identity
+    micropython.native = _identity
+    micropython.mem_info = lambda *args: None
+    sys.modules['micropython'] = micropython
+
+    time.ticks_ms = lambda: time.monotonic_ns()//1000_000
+    time.ticks_us = lambda: time.monotonic_ns()//1000
+    time.ticks_cpu = time.ticks_us
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+    time.sleep_ms = lambda ms: time.sleep(ms/1000)
+    sys.modules['utime'] = time
+
+    asyncio.sleep_ms = lambda ms: asyncio.sleep(ms/1000)
+    asyncio.wait_for_ms = lambda aw, ms: asyncio.wait_for(aw, ms/1000)
+    asyncio.ThreadSafeFlag = _thread_safe_flag()
+    sys.modules['uasyncio'] = asyncio # primitives
+
+    sys.print_exception = lambda err, file=None: traceback.print_exception(err, file=file)
+
+    deflate = new_module('deflate')
+    deflate.AUTO, deflate.RAW, deflate.ZLIB, deflate.GZIP = 0, 1, 2, 3
+    deflate.DeflateIO = DeflateIO
+    sys.modules['deflate'] = deflate
+
+    ccrc = new_module('ccrc')
+    ccrc.crc16 = _crc16
+    ccrc.crc16_ccit = _crc16_ccit
+    sys.modules['ccrc'] = ccrc
@@ -0,0 +1,118 @@
+
+# Run clock_coro and display_coro on the simulator, no hardware needed.
+# Records the neopixel frames and reports the time spent in each stage.
+#   python3 tools/sim_display.py [callen|celeste] [seconds] [hh:mm:ss]
+#   micropython tools/sim_display.py celeste 5 21:30:00
+#   python3 tools/sim_display.py --check   first frame of each of CASES vs tools/baselines/display.json
+#   python3 tools/sim_display.py --save    store them as the baseline
+# The first frame is fixed by the start time and mode, the colour by the
+# time (callen), the rainbow's first shift (celeste) or night mode.
+
+import sys
+import json
+import binascii
+sys.path.insert(0, 'tools')
+
+import sim
+
+BASELINE_PATH = 'tools/baselines/display.json'
+
+# name, mode, start (hh, mm, ss), None before the ntp sync
+CASES = [
+    ('callen day',     'callen',  (12, 34, 56)),
+    ('callen night',   'callen',  (21, 30, 0)),
+    ('celeste day',    'celeste', (12, 35, 1)),
+    ('celeste no ntp', 'celeste', None),
+]
+CASE_SECONDS = 0.1 # well inside the first second
+
+def parse_args(argv):
+    argv = [a for a in argv if not a.startswith('--')]
+    mode = argv[1] if len(argv) > 1 else 'callen'
+    seconds = float(argv[2]) if len(argv) > 2 else 5
+    start = None
+    if len(argv) > 3:
+        hr, min, sec = [int(x) for x in argv[3].split(':')]
+        start = (2026, 10, 18, hr, min, sec, 0)
+    return (mode, seconds, start)
+
+(mode_name, seconds, start) = parse_args(sys.argv)
+sim.install(start = start)
+
+import asyncio
+from machine import Pin
+from neopixel import NeoPixel
+import display
+import clock
+
+async def run(mode, seconds):
+    frame = display.Frame()
+    neo = NeoPixel(Pin(18), display.NEOPIXELS_LEN)
+    tasks = [
+        asyncio.create_task(clock.clock_coro(frame = frame,
+                                             mode  = mode)),
+        asyncio.create_task(display.display_coro(frame = frame,
+                                                 neo   = neo,
+                                                 mode  = mode)),
+    ]
+    await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.sleep(0)
+    return frame
+
+def mode_of(name):
+    return display.CELESTE_MODE if name == 'celeste' else display.CALLEN_MODE
+
+# hex of the first frame written in each case
+def run_cases():
+    results = {}
+    for (name, mode, start) in CASES:
+        sim.clock.set((2026, 10, 18) + start + (0,) if start else (2000, 1, 1, 0, 0, 0, 0))
+        sim.frames.clear()
+        asyncio.run(run(mode_of(mode), CASE_SECONDS))
+        results[name] = binascii.hexlify(sim.frames[0][1]).decode() if sim.frames else ''
+    return results
+
+def check(save):
+    results = run_cases()
+    if save:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f)
+        print('saved', BASELINE_PATH)
+        return
+    with open(BASELINE_PATH) as f:
+        base = json.load(f)
+    failed = []
+    for (name, mode, start) in CASES:
+        ok = results[name] == base.get(name)
+        print('{:<16} {}'.format(name, 'ok' if ok else 'MISMATCH'))
+        if not ok:
+            failed.append(name)
+            if name in base:
+                print(sim.frame_to_ascii(binascii.unhexlify(base[name])))
+            print(sim.frame_to_ascii(binascii.unhexlify(results[name])))
+    if failed:
+        sys.exit(1)
+
+def main():
+    if '--check' in sys.argv or '--save' in sys.argv:
+        check('--save' in sys.argv)
+        return
+    mode = mode_of(mode_name)
+
+    prof = sim.Profiler()
+    prof.wrap(clock, 'write_text')
+    prof.wrap(display.Palette, 'render', 'Palette.render')
+    prof.wrap(NeoPixel, 'write', 'NeoPixel.write')
+
+    frame = asyncio.run(run(mode, seconds))
+
+    print('mode {} {}s, {} frames written'.format(mode_name, seconds, len(sim.frames)))
+    print('rendered', frame.rendered, 'skipped', frame.skipped,
+          'text hits', display.text_cache.hits, 'misses', display.text_cache.misses)
+    prof.report()
+    if sim.frames:
+        print(sim.frame_to_ascii(sim.frames[-1][1]))
+
+main()
@@ -0,0 +1,287 @@
+
+# End to end ota transfer on the simulator, tools/pushfw.py's OTASender to
+# src/ota.py's OTAWriter through a stand-in for the mqtt broker.  The link
+# is modelled by a bandwidth and a one way latency, flash by a write time
+# per page.  Reports the transfer time and checks the written image and
+# the deflate stream's carry between chunks, fails on a restarted transfer.
+#   python3 tools/sim_ota.py [--delta|--full] [--loss=<%>] [--mqtt] [image KB] [link KB/s] [latency ms] [chunk pages] [window]
+#   python3 tools/sim_ota.py 1024 100 60 4 4
+# --delta runs the device on an older image that differs from the new one
+# in a 48KB block and a few scattered pages, as an app only change does.
+# --full sends every page, no manifest.
+# --loss=<%> drops that share of messages both ways.
+# --mqtt runs the device end through mqtt.core.MQTTCore (mqtt 5) as main.py
+# does, over Broker below, which holds publishes to the Maximum Packet Size
+# the device sent in its CONNECT.
+
+import sys
+import random
+sys.path.insert(0, 'tools')
+
+import sim
+sim.install()
+
+import asyncio
+import esp32
+import ota
+from ota import OTAWriter
+from ota import OTA_BLOCK_SIZE
+from mqtt.router import MQTTRouter
+from mqtt.defs import Publish_struct
+from mqtt.defs import PROTOCOL_LEVEL_5
+from mqtt.core import MQTTCore
+from mqtt import defs
+from mqtt import encdec
+from wifi.stream import RxStream
+from wifi.levelqueue import LevelQueue
+from pushfw import OTASender
+
+FLASH_PAGE_MS = 45 # erase + write of a 4KB page
+LEGACY_SLEEP  = 0.75 # the old pushfw, one page per publish then sleep
+CARRY_MAX     = 6 # the sync flush tail the device is left with, end of block
+                  # code, the empty stored block's header and LEN/NLEN
+
+def args(argv):
+    a = [float(x) for x in argv[1:] if not x.startswith('--')]
+    d = [1024, 100, 60, 4, 4]
+    a += d[len(a):]
+    return (int(a[0])*1024, a[1]*1024, a[2]/1000, int(a[3]), int(a[4]))
+
+# firmware like data, compresses about 2:1
+def make_image(size):
+    rnd = random.Random(1)
+    words = [bytes(rnd.getrandbits(8) for _ in range(rnd.randint(2, 12))) for _ in range(512)]
+    b = bytearray()
+    while len(b) < size:
+        b += rnd.choice(words) if rnd.random() < 0.7 else bytes(rnd.getrandbits(8) for _ in range(8))
+    return bytes(b[:size])
+
+def make_old_image(image):
+    b = bytearray(image)
+    n = len(b)//OTA_BLOCK_SIZE
+    for page in list(range(n//2, n//2+12)) + [3, n//3, n-2]:
+        b[page*OTA_BLOCK_SIZE+100:page*OTA_BLOCK_SIZE+108] = b'oldimage'
+    return bytes(b)
+
+def loss_arg(argv):
+    for a in argv:
+        if a.startswith('--loss='):
+            return float(a[7:])/100
+    return 0
+
+# messages are serialized onto the link at bps then arrive latency later,
+# or are lost
+class Link:
+    def __init__(self, bps, latency, deliver, loss=0):
+        self.bps = bps
+        self.latency = latency
+        self.deliver = deliver
+        self.loss = loss
+        self.rnd = random.Random(2)
+        self.lost = 0
+        self.q = asyncio.Queue()
+        self.task = asyncio.create_task(self.coro())
+
+    async def send(self, topic, payload):
+        await self.q.put((topic, payload))
+
+    async def arrive(self, msg):
+        await asyncio.sleep(self.latency)
+        await self.deliver(*msg)
+
+    async def coro(self):
+        while True:
+            msg = await self.q.get()
+            await asyncio.sleep((len(msg[0])+len(msg[1])+4)/self.bps)
+            if self.rnd.random() < self.loss:
+                self.lost += 1
+                continue
+            asyncio.create_task(self.arrive(msg))
+
+# The broker end of the device's connection, in place of the WifiSocket
+# MQTTCore runs over (rx_stream, tx_q, is_closed, flush).  Packets from the
+# device are answered (connack, suback, pingresp) or, publishes, passed to
+# the down link, publishes from the up link are written into rx_stream.
+# Like an mqtt 5 broker it won't send a publish over the client's Maximum
+# Packet Size, the sim fails on it instead of stalling.  Grants topic
+# aliases and resolves the device's.
+class Broker:
+    def __init__(self, down):
+        self.down = down
+        self.rx_stream = RxStream()
+        self.tx_q = LevelQueue(max_bytes = 8*1024)
+        self.is_closed = asyncio.Event()
+        self.max_pkt_size = None # the client's, from its CONNECT
+        self.aliases = {}
+        self.task = asyncio.create_task(self.coro())
+
+    def flush(self):
+        pass
+
+    # a publish for the device, from the up link
+    async def deliver(self, topic, payload):
+        pkt = encdec.encode_publish(topic.encode(), payload, retain = False, v5 = True)
+        if self.max_pkt_size is not None and len(pkt) > self.max_pkt_size:
+            raise SystemExit('broker dropped a {} byte publish, the device takes {}'.format(
+                len(pkt), self.max_pkt_size))
+        await self.write(pkt)
+
+    # into the device's rx buffer as it makes room
+    async def write(self, pkt):
+        rx = self.rx_stream
+        mv = memoryview(pkt)
+        while mv:
+            await rx.space.wait()
+            window = rx.window()
+            n = min(len(window), len(mv))
+            window[:n] = mv[:n]
+            rx.commit(n)
+            mv = mv[n:]
+
+    async def coro(self):
+        while True:
+            mv = memoryview(await self.tx_q.get())
+            t = mv[0] & 0xf0
+            (_, k) = encdec.decode_remaining_length(mv[1:5])
+            if t == defs.CONNECT:
+                # protocol name, level, flags and keep alive then properties
+                (props, _) = encdec.decode_properties(mv, 1+k+10)
+                self.max_pkt_size = (props or {}).get(defs.PROP_MAXIMUM_PACKET_SIZE)
+                body = b'\x00\x00' + encdec.encode_properties([(defs.PROP_TOPIC_ALIAS_MAXIMUM, 4)])
+                await self.write(bytes([defs.CONNACK]) + encdec.encode_remaining_length(len(body)) + body)
+            elif t == defs.SUBSCRIBE:
+                body = bytes(mv[1+k:3+k]) + b'\x00\x01' # packet id, no properties, qos 1
+                await self.write(bytes([defs.SUBACK]) + encdec.encode_remaining_length(len(body)) + body)
+            elif t == defs.PINGREQ:
+                await self.write(bytes([defs.PINGRESP, 0]))
+            elif t == defs.PUBLISH:
+                msg = encdec.decode_publish(mv, v5 = True)
+                topic = msg.topic
+                if msg.topic_alias:
+                    if topic:
+                        self.aliases[msg.topic_alias] = topic
+                    else:
+                        topic = self.aliases[msg.topic_alias]
+                await self.down.send(topic.decode(), msg.payload)
+
+async def run(image, bps, latency, chunk_pages, window, delta, loss, use_mqtt):
+    writer = OTAWriter()
+    write = writer.write
+    async def slow_write(page):
+        await asyncio.sleep(FLASH_PAGE_MS/1000)
+        await write(page)
+    writer.write = slow_write
+    # the writer starts over on a chunk it can't take, in the sim that's a
+    # bug and the sender would resend for ever, fail instead
+    starting = False
+    reset = writer.reset
+    def checked_reset(image_pages = 0):
+        if not starting:
+            raise SystemExit('ota transfer restarted')
+        reset(image_pages)
+    writer.reset = checked_reset
+
+    inbox = asyncio.Queue()
+    async def to_device(topic, payload):
+        await inbox.put((topic, payload))
+    async def to_sender(topic, payload):
+        sender.on_msg(topic.rsplit('/', 1)[-1], payload)
+    down = Link(bps, latency, to_sender, loss)
+    if use_mqtt:
+        broker = Broker(down)
+        up = Link(bps, latency, broker.deliver, loss)
+    else:
+        up = Link(bps, latency, to_device, loss)
+    async def publish(topic, payload):
+        await down.send(topic.decode(), payload)
+
+    # main.mqtt_rx_coro and main.ota_handler
+    done = asyncio.Event()
+    async def on_ota(msg, rest):
+        nonlocal starting
+        cmd = bytes(rest)
+        if cmd == b'ack' or cmd == b'nack' or cmd == b'crcs':
+            return
+        starting = cmd == b'start'
+        reply = await writer.on_msg(cmd, msg.payload)
+        if reply:
+            await publish(b'ki5tof/ota/'+reply[0], reply[1])
+        if cmd == b'done' and writer.verified:
+            done.set()
+    router = MQTTRouter()
+    router.add(b'ki5tof/ota/+', on_ota)
+    async def mqtt_device():
+        nonlocal publish, router
+        async with MQTTCore(socket    = broker,
+                            client_id = 'sim',
+                            zerocopy  = True,
+                            protocol  = PROTOCOL_LEVEL_5,
+                            ) as mqtt:
+            async def publish(topic, payload):
+                await mqtt.publish(topic = topic, payload = payload, qos = 0)
+            router = MQTTRouter(topics = mqtt.topics)
+            router.add(b'ki5tof/ota/+', on_ota)
+            await mqtt.subscribe(topics = [b'ki5tof/#'], no_local = True)
+            while not done.is_set():
+                msg = await mqtt.mqtt_app_rx_q.get()
+                try:
+                    await router.dispatch(msg)
+                finally:
+                    mqtt.release()
+        broker.task.cancel()
+    async def device():
+        while not done.is_set():
+            (topic, payload) = await inbox.get()
+            await router.dispatch(Publish_struct(packet_id = None,
+                                                 qos       = 0,
+                                                 topic     = memoryview(topic.encode()),
+                                                 payload   = memoryview(payload),
+                                                 topic_alias = 0,
+                                                 topic_id  = -1))
+
+    sender = OTASender(publish     = up.send,
+                       fw          = image,
+                       chunk_pages = chunk_pages,
+                       window      = window,
+                       delta       = delta)
+    device_task = asyncio.create_task(mqtt_device() if use_mqtt else device())
+    secs = await sender.run()
+    await device_task
+    up.task.cancel()
+    down.task.cancel()
+    if loss:
+        print('lost', up.lost, 'to the device', down.lost, 'to the sender')
+    return (sender, writer, secs)
+
+def main():
+    (size, bps, latency, chunk_pages, window) = args(sys.argv)
+    image = make_image(size)
+    running = esp32.Partition(esp32.Partition.RUNNING)
+    if '--delta' in sys.argv:
+        old = make_old_image(image)
+        running.mem[:len(old)] = old
+    delta = '--full' not in sys.argv
+    (sender, writer, secs) = asyncio.run(run(image, bps, latency, chunk_pages, window, delta,
+                                             loss_arg(sys.argv), '--mqtt' in sys.argv))
+
+    part = esp32.Partition(esp32.Partition.BOOT)
+    ok = bytes(part.mem[:len(image)]) == image
+    print('image {} KB, link {:.0f} KB/s {:.0f}ms, flash {}ms/page, chunk {} pages, window {}'.format(
+        size//1024, bps/1024, latency*1000, FLASH_PAGE_MS, chunk_pages, window))
+    sender.print_stats(secs)
+    pages = sender.num_pages
+    legacy = pages*(LEGACY_SLEEP + 2*latency + FLASH_PAGE_MS/1000)
+    print('legacy one page per publish + {}s sleep: ~{:.0f}s'.format(LEGACY_SLEEP, legacy))
+    print('image', 'OK' if ok else 'MISMATCH')
+    # unread bytes of a chunk's stream kept for the next chunk, more than
+    # the sync flush tail means the inflate stopped short of the chunk's
+    # end.  PayloadReader.keep() fails past the carry buffer, that's the
+    # restart check.  Exercised only with the sim's byte-wise DeflateIO,
+    # like the device's.
+    reader = writer.reader
+    carry_ok = reader.carry_hw <= CARRY_MAX
+    print('carry hw', reader.carry_hw, 'of', CARRY_MAX, 'OK' if carry_ok else 'OVER')
+    if not ok or not carry_ok:
+        sys.exit(1)
+
+main()
@@ -0,0 +1,57 @@
+
+# Local TLS echo server for tools/bench_sockio.py.  CPython.
+#   python3 tools/tls_echo_server.py [port]
+# A self signed certificate is made with openssl for each run in a temp
+# dir, removed on exit, the key never lands in the tree.
+
+import asyncio
+import os
+import signal
+import ssl
+import subprocess
+import sys
+import tempfile
+
+PORT = 8883
+
+# (cert, key) paths in dir
+def make_cert(dir):
+    cert = os.path.join(dir, 'echo_cert.pem')
+    key = os.path.join(dir, 'echo_key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec',
+                    '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    return (cert, key)
+
+async def echo(reader, writer):
+    try:
+        while data := await reader.read(4096):
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, ssl.SSLError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(port, cert, key):
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(cert, key)
+    server = await asyncio.start_server(echo, '127.0.0.1', port, ssl=ctx)
+    print('tls echo on 127.0.0.1:{}'.format(port))
+    async with server:
+        await server.serve_forever()
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # cleans up too
+    with tempfile.TemporaryDirectory() as dir:
+        (cert, key) = make_cert(dir)
+        try:
+            asyncio.run(serve(port, cert, key))
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()